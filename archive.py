@@ -0,0 +1,234 @@
+import argparse
+import os
+import sqlite3
+import time
+import zipfile
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from face_chips import CHIP_DIR, CHIP_SHAPE, get_chip_file, load_chips, init_chip_tables
+from reembed import init_reembed_tables
+
+DB_PATH = 'attendance.db'
+ARCHIVE_DIR = 'archive'
+IMAGE_DIR = 'student_images'
+ARCHIVE_IMAGE_SIZE = 320
+ARCHIVE_JPEG_QUALITY = 70
+
+# Bảng thông tin các buổi thực tập đã được lưu trữ
+def init_archive_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS archived_sessions
+                 (id INTEGER PRIMARY KEY, class_name TEXT, session_date TEXT, session_day TEXT, start_time TEXT, end_time TEXT,
+                  max_attendance_score INTEGER, archive_path TEXT, archived_at TEXT, student_count INTEGER, attendance_count INTEGER)''')
+    conn.commit()
+
+# Lấy danh sách buổi thực tập đã lưu trữ
+def get_archived_sessions(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    init_archive_tables(conn)
+    sessions = conn.execute("SELECT * FROM archived_sessions ORDER BY session_date, id").fetchall()
+    conn.close()
+    return sessions
+
+def get_archived_session_info(session_id, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    session = conn.execute("SELECT * FROM archived_sessions WHERE id = ?", (session_id,)).fetchone()
+    conn.close()
+    return session
+
+# Đọc danh sách điểm danh của buổi đã lưu trữ (cùng định dạng với get_attendance_list)
+def load_archived_attendance(session_id, db_path=DB_PATH):
+    session = get_archived_session_info(session_id, db_path)
+    if session is None:
+        return []
+    with np.load(os.path.join(session['archive_path'], 'data.npz'), allow_pickle=False) as data:
+        present = data['attendance_status'] == 'present'
+        columns = [data[key][present].tolist() for key in
+                   ('attendance_student_id', 'attendance_name', 'attendance_timestamp', 'attendance_score', 'attendance_note')]
+    return [row + (session['class_name'], session['session_date'], session['session_day'], session['start_time'], session['end_time'])
+            for row in zip(*columns)]
+
+# Thu nhỏ và nén lại ảnh gốc để lưu trữ
+def _recompress_image(image_path):
+    image = Image.open(image_path).convert('RGB')
+    image.thumbnail((ARCHIVE_IMAGE_SIZE, ARCHIVE_IMAGE_SIZE))
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=ARCHIVE_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+def _text_array(values):
+    return np.array(['' if value is None else str(value) for value in values], dtype=str)
+
+# Chuyển đổi cơ sở dữ liệu sang chế độ incremental vacuum (chỉ cần VACUUM đầy đủ một lần)
+def enable_incremental_vacuum(conn):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+# Lưu trữ một buổi thực tập: ghi file nén, sau đó mới xóa dữ liệu khỏi cơ sở dữ liệu
+def archive_session(session_id, db_path=DB_PATH, archive_dir=ARCHIVE_DIR, chip_dir=CHIP_DIR):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    init_archive_tables(conn)
+    init_chip_tables(conn, chip_dir)
+    init_reembed_tables(conn)
+    session = conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    if session is None:
+        conn.close()
+        raise ValueError(f"Không tìm thấy buổi thực tập {session_id}")
+    students = conn.execute("SELECT record_id, id, name, embedding, image_path, model_version FROM students WHERE session_id = ? ORDER BY record_id",
+                            (session_id,)).fetchall()
+    attendance = conn.execute("""
+        SELECT a.student_id, s.name, a.status, a.timestamp, a.attendance_score, a.note
+        FROM attendance a
+        LEFT JOIN (SELECT id, MAX(name) as name FROM students GROUP BY id) s ON a.student_id = s.id
+        WHERE a.session_id = ?
+    """, (session_id,)).fetchall()
+
+    session_dir = os.path.join(archive_dir, f"session_{session_id}")
+    os.makedirs(session_dir, exist_ok=True)
+    image_names = []
+    with zipfile.ZipFile(os.path.join(session_dir, 'images.zip'), 'w', zipfile.ZIP_STORED) as zip_file:
+        for student in students:
+            image_path = student['image_path']
+            if image_path and os.path.exists(image_path):
+                image_name = f"{student['record_id']}_{os.path.basename(image_path)}"
+                zip_file.writestr(image_name, _recompress_image(image_path))
+                image_names.append(image_name)
+            else:
+                image_names.append('')
+
+    chip_record_ids, chips, chip_kps = load_chips(session_id, db_path=db_path, chip_dir=chip_dir)
+    embeddings = [np.frombuffer(student['embedding'], dtype=np.float32) for student in students]
+    np.savez_compressed(
+        os.path.join(session_dir, 'data.npz'),
+        student_record_id=np.array([student['record_id'] for student in students], dtype=np.int64),
+        student_id=_text_array(student['id'] for student in students),
+        student_name=_text_array(student['name'] for student in students),
+        student_model_version=_text_array(student['model_version'] for student in students),
+        student_image=_text_array(image_names),
+        embeddings=np.stack(embeddings) if embeddings else np.empty((0, 512), dtype=np.float32),
+        chip_record_id=np.array(chip_record_ids, dtype=np.int64),
+        chips=np.asarray(chips) if len(chips) else np.empty((0,) + CHIP_SHAPE, dtype=np.uint8),
+        chip_kps=chip_kps,
+        attendance_student_id=_text_array(row['student_id'] for row in attendance),
+        attendance_name=_text_array(row['name'] for row in attendance),
+        attendance_status=_text_array(row['status'] for row in attendance),
+        attendance_timestamp=_text_array(row['timestamp'] for row in attendance),
+        attendance_score=np.array([row['attendance_score'] or 0 for row in attendance], dtype=np.int64),
+        attendance_note=_text_array(row['note'] for row in attendance),
+    )
+    # Kiểm tra file lưu trữ đọc lại được trước khi xóa dữ liệu gốc
+    with np.load(os.path.join(session_dir, 'data.npz'), allow_pickle=False) as data:
+        if len(data['student_record_id']) != len(students) or len(data['attendance_student_id']) != len(attendance):
+            conn.close()
+            raise RuntimeError(f"File lưu trữ của buổi {session_id} không đầy đủ")
+
+    with conn:
+        conn.execute("""INSERT OR REPLACE INTO archived_sessions
+                        (id, class_name, session_date, session_day, start_time, end_time, max_attendance_score, archive_path, archived_at, student_count, attendance_count)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (session_id, session['class_name'], session['session_date'], session['session_day'], session['start_time'],
+                      session['end_time'], session['max_attendance_score'], session_dir, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                      len(students), len(attendance)))
+        conn.execute("DELETE FROM attendance WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM face_chips WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM face_chip_free_slots WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM reembed_staging WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM students WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    # Chỉ xóa ảnh gốc không còn được bản ghi nào khác sử dụng
+    for student in students:
+        image_path = student['image_path']
+        if image_path and os.path.exists(image_path):
+            still_used = conn.execute("SELECT 1 FROM students WHERE image_path = ? LIMIT 1", (image_path,)).fetchone()
+            if not still_used:
+                os.remove(image_path)
+    chip_file = get_chip_file(session_id, chip_dir)
+    if os.path.exists(chip_file):
+        os.remove(chip_file)
+    conn.close()
+    return session_dir
+
+# Giải phóng các trang trống sau khi xóa dữ liệu
+def reclaim_space(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    enable_incremental_vacuum(conn)
+    conn.execute("PRAGMA incremental_vacuum")
+    conn.commit()
+    conn.close()
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+def _storage_size(db_path, chip_dir):
+    return os.path.getsize(db_path) + _dir_size(IMAGE_DIR) + _dir_size(chip_dir)
+
+# Đo thời gian truy vấn danh sách điểm danh và embedding trên các buổi session_ids (mặc định: tất cả các buổi).
+# Để so sánh trước/sau khi lưu trữ, hai lần đo phải dùng cùng tập buổi còn lại.
+def measure_query_latency(db_path=DB_PATH, repeats=5, session_ids=None):
+    conn = sqlite3.connect(db_path)
+    if session_ids is None:
+        session_ids = [row[0] for row in conn.execute("SELECT id FROM sessions").fetchall()]
+    if not session_ids:
+        conn.close()
+        return None
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for session_id in session_ids:
+            conn.execute("""
+                SELECT a.student_id, s.name, a.timestamp, a.attendance_score, a.note, ses.class_name, ses.session_date, ses.session_day, ses.start_time, ses.end_time
+                FROM attendance a
+                JOIN (SELECT id, MAX(name) as name FROM students GROUP BY id) s ON a.student_id = s.id
+                JOIN sessions ses ON a.session_id = ses.id
+                WHERE a.session_id = ? AND a.status = 'present'
+            """, (session_id,)).fetchall()
+            conn.execute("SELECT record_id, id, name, embedding FROM students WHERE session_id = ?", (session_id,)).fetchall()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed / (repeats * len(session_ids))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Lưu trữ các buổi thực tập cũ để giảm kích thước cơ sở dữ liệu và thư mục ảnh")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--chip-dir', default=CHIP_DIR)
+    parser.add_argument('--session-id', type=int, nargs='*', default=[], help="Các buổi thực tập cần lưu trữ")
+    parser.add_argument('--before', help="Lưu trữ tất cả các buổi trước ngày này (YYYY-MM-DD)")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    session_ids = list(args.session_id)
+    if args.before:
+        session_ids += [row[0] for row in conn.execute("SELECT id FROM sessions WHERE session_date < ?", (args.before,)).fetchall()]
+    session_ids = sorted(set(session_ids))
+    remaining_ids = [row[0] for row in conn.execute("SELECT id FROM sessions").fetchall() if row[0] not in session_ids]
+    conn.close()
+    if not session_ids:
+        parser.error("Không có buổi thực tập nào được chọn (dùng --session-id hoặc --before)")
+    if args.dry_run:
+        print("Các buổi sẽ được lưu trữ:", ', '.join(str(session_id) for session_id in session_ids))
+    else:
+        size_before = _storage_size(args.db, args.chip_dir)
+        latency_before = measure_query_latency(args.db, session_ids=remaining_ids)
+        for session_id in session_ids:
+            session_dir = archive_session(session_id, args.db, args.archive_dir, args.chip_dir)
+            print(f"Đã lưu trữ buổi {session_id} vào {session_dir}")
+        reclaim_space(args.db)
+        size_after = _storage_size(args.db, args.chip_dir)
+        latency_after = measure_query_latency(args.db, session_ids=remaining_ids)
+        print(f"Dung lượng (DB + ảnh + ảnh khuôn mặt): {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB "
+              f"(giải phóng {(size_before - size_after) / 1e6:.1f} MB, lưu trữ chiếm {_dir_size(args.archive_dir) / 1e6:.1f} MB)")
+        if latency_before is not None and latency_after is not None:
+            print(f"Thời gian truy vấn trung bình mỗi buổi còn lại ({len(remaining_ids)} buổi): {latency_before * 1000:.2f} ms -> {latency_after * 1000:.2f} ms")
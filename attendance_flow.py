@@ -0,0 +1,151 @@
+import sqlite3
+import time
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+from calibrate import DEFAULT_MATCH_CONFIG
+from events import event_bus
+from scoring import score_attendance, TIMESTAMP_FORMAT
+
+DB_PATH = 'attendance.db'
+
+# Thiết lập múi giờ Việt Nam (UTC+7)
+tz = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Tải embedding của sinh viên theo session_id
+def load_embeddings_by_session(session_id, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT record_id, id, name, embedding FROM students WHERE session_id = ?", (session_id,))
+    students = c.fetchall()
+    conn.close()
+    embeddings = []
+    record_ids = []
+    ids = []
+    names = []
+    for student in students:
+        record_ids.append(student[0])
+        ids.append(student[1])
+        names.append(student[2])
+        embeddings.append(np.frombuffer(student[3], dtype=np.float32))
+    return record_ids, ids, names, embeddings
+
+# Tìm sinh viên khớp nhất theo độ đo và ngưỡng của điểm vận hành (mặc định: khoảng cách Euclid < 20.0)
+def find_closest_match(embedding, record_ids, ids, names, embeddings,
+                       threshold=DEFAULT_MATCH_CONFIG['threshold'], metric=DEFAULT_MATCH_CONFIG['metric']):
+    if len(embeddings) == 0:
+        return None, None, None
+    gallery = np.asarray(embeddings, dtype=np.float32)
+    if metric == 'cosine':
+        scores = gallery @ embedding / (np.linalg.norm(gallery, axis=1) * np.linalg.norm(embedding) + 1e-12)
+        index = int(np.argmax(scores))
+        matched = scores[index] >= threshold
+    else:
+        distances = np.linalg.norm(gallery - embedding, axis=1)
+        index = int(np.argmin(distances))
+        matched = distances[index] < threshold
+    if matched:
+        # Ảnh chụp dùng chung trả về số và chuỗi NumPy, chuyển về kiểu Python trước khi ghi vào cơ sở dữ liệu
+        return int(record_ids[index]), str(ids[index]), str(names[index])
+    return None, None, None
+
+# Kiểm tra xem sinh viên đã được điểm danh trong buổi thực tập chưa
+def check_attendance(session_id, student_id, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT * FROM attendance WHERE session_id = ? AND student_id = ?", (session_id, student_id))
+    result = c.fetchone()
+    conn.close()
+    return result is not None
+
+# Lấy danh sách sinh viên đã điểm danh trong buổi thực tập
+def get_attendance_list(session_id, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("""
+        SELECT a.student_id, s.name, a.timestamp, a.attendance_score, a.note, ses.class_name, ses.session_date, ses.session_day, ses.start_time, ses.end_time
+        FROM attendance a
+        JOIN (SELECT id, MAX(name) as name FROM students GROUP BY id) s ON a.student_id = s.id
+        JOIN sessions ses ON a.session_id = ses.id
+        WHERE a.session_id = ? AND a.status = 'present'
+    """, (session_id,))
+    attendance_list = c.fetchall()
+    conn.close()
+    return attendance_list
+
+# Ghi nhận điểm danh. Khóa ghi được lấy riêng (BEGIN IMMEDIATE) để đo thời gian chờ khóa của cơ sở dữ liệu;
+# trả về False nếu sinh viên đã được một thiết bị khác điểm danh trong lúc chờ.
+# Sau khi ghi thành công, sự kiện 'attendance_marked' được gửi lên bus (mặc định: event_bus).
+def mark_attendance(session_id, student_id, timestamp, attendance_score, note, db_path=DB_PATH, timings=None,
+                    student_name=None, bus=None):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        if timings is not None:
+            timings['lock_wait'] = time.perf_counter() - start
+        if conn.execute("SELECT 1 FROM attendance WHERE session_id = ? AND student_id = ?", (session_id, student_id)).fetchone():
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute("INSERT INTO attendance (session_id, student_id, status, timestamp, attendance_score, note) VALUES (?, ?, 'present', ?, ?, ?)",
+                     (session_id, student_id, timestamp, attendance_score, note))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    (event_bus if bus is None else bus).publish('attendance_marked', session_id=session_id, student_id=student_id,
+                                                student_name=student_name, timestamp=timestamp,
+                                                attendance_score=attendance_score, note=note)
+    return True
+
+# Kết quả xử lý một khung hình điểm danh
+class AttendanceResult:
+    def __init__(self, status, record_id=None, student_id=None, student_name=None, timestamp=None, attendance_score=None, note=None):
+        # status: 'no_face', 'unknown', 'already_marked' hoặc 'marked'
+        self.status = status
+        self.record_id = record_id
+        self.student_id = student_id
+        self.student_name = student_name
+        self.timestamp = timestamp
+        self.attendance_score = attendance_score
+        self.note = note
+
+# Xử lý một khung hình: phát hiện, so khớp, kiểm tra và ghi nhận điểm danh.
+# Nếu truyền timings (dict), thời gian của từng bước được ghi vào đó.
+def process_attendance_frame(recognizer, img_array, session_id, session_info, gallery, match_config=DEFAULT_MATCH_CONFIG,
+                             db_path=DB_PATH, timings=None, bus=None):
+    timings = {} if timings is None else timings
+    record_ids, ids, names, embeddings = gallery
+
+    start = time.perf_counter()
+    faces = recognizer.app.get(img_array)
+    timings['detect'] = time.perf_counter() - start
+    if len(faces) != 1:
+        return AttendanceResult('no_face')
+
+    start = time.perf_counter()
+    record_id, student_id, student_name = find_closest_match(faces[0].embedding, record_ids, ids, names, embeddings,
+                                                             match_config['threshold'], match_config['metric'])
+    timings['match'] = time.perf_counter() - start
+    if record_id is None:
+        return AttendanceResult('unknown')
+
+    start = time.perf_counter()
+    already_marked = check_attendance(session_id, student_id, db_path)
+    timings['check'] = time.perf_counter() - start
+    if already_marked:
+        return AttendanceResult('already_marked', record_id, student_id, student_name)
+
+    timestamp = datetime.now(tz).strftime(TIMESTAMP_FORMAT)
+    attendance_score, note = score_attendance(session_info, timestamp)
+    start = time.perf_counter()
+    marked = mark_attendance(session_id, student_id, timestamp, attendance_score, note, db_path, timings, student_name, bus)
+    timings['mark'] = time.perf_counter() - start
+    if not marked:
+        return AttendanceResult('already_marked', record_id, student_id, student_name)
+    return AttendanceResult('marked', record_id, student_id, student_name, timestamp, attendance_score, note)
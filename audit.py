@@ -0,0 +1,224 @@
+import argparse
+import csv
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import numpy as np
+
+DB_PATH = 'attendance.db'
+REPORT_DIR = 'audit_reports'
+RAM_BUDGET_MB = 256
+EMBEDDING_DIM = 512
+# Ngưỡng tương đồng cosine: hai MSSV khác nhau giống nhau hơn mức này được xem là trùng khuôn mặt
+DUPLICATE_THRESHOLD = 0.5
+# Bản ghi không giống bất kỳ bản ghi nào khác cùng MSSV hơn mức này được xem là bất thường
+OUTLIER_THRESHOLD = 0.3
+
+# Trạng thái của lần kiểm tra trước, dùng cho chế độ chỉ kiểm tra bản ghi mới
+def init_audit_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS audit_state
+                 (key TEXT PRIMARY KEY, value TEXT)''')
+    conn.commit()
+
+# Tập embedding (đã chuẩn hóa) nằm liên tục trong một mảng duy nhất
+class Gallery:
+    def __init__(self, record_ids, ids, names, session_ids, embeddings, norms):
+        self.record_ids = record_ids
+        self.ids = ids
+        self.names = names
+        self.session_ids = session_ids
+        self.embeddings = embeddings
+        self.norms = norms
+        # Mã số nguyên của MSSV để so sánh theo khối bằng NumPy
+        _, self.id_codes = np.unique(ids, return_inverse=True)
+
+    def __len__(self):
+        return len(self.record_ids)
+
+# Đọc toàn bộ embedding của một phiên bản mô hình vào một ma trận float32 liên tục
+def load_gallery(model_version, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    if model_version is None:
+        where, params = "model_version IS NULL", ()
+    else:
+        where, params = "model_version = ?", (model_version,)
+    c.execute(f"SELECT COUNT(*) FROM students WHERE {where}", params)
+    n = c.fetchone()[0]
+    embeddings = np.empty((n, EMBEDDING_DIM), dtype=np.float32)
+    record_ids = np.empty(n, dtype=np.int64)
+    session_ids = np.empty(n, dtype=np.int64)
+    ids = []
+    names = []
+    c.execute(f"SELECT record_id, id, name, session_id, embedding FROM students WHERE {where} ORDER BY record_id", params)
+    i = 0
+    for record_id, student_id, name, session_id, embedding in c:
+        if i >= n:
+            break
+        embeddings[i] = np.frombuffer(embedding, dtype=np.float32)
+        record_ids[i] = record_id
+        session_ids[i] = session_id if session_id is not None else -1
+        ids.append(student_id)
+        names.append(name)
+        i += 1
+    conn.close()
+    norms = np.linalg.norm(embeddings[:i], axis=1)
+    embeddings = embeddings[:i]
+    embeddings /= np.maximum(norms, 1e-12)[:, None]
+    return Gallery(record_ids[:i], np.array(ids, dtype=str), np.array(names, dtype=str), session_ids[:i], embeddings, norms)
+
+# Kích thước khối sao cho các ma trận tạm của một khối nằm trong giới hạn bộ nhớ
+# Mặc định mỗi phần tử của khối cần khoảng 12 byte: ma trận float32 và vài mặt nạ bool/float tạm
+def block_size_for_budget(ram_budget_mb=RAM_BUDGET_MB, bytes_per_element=12):
+    return max(64, int(np.sqrt(ram_budget_mb * 1024 * 1024 / bytes_per_element)))
+
+# Duyệt ma trận tương đồng cosine giữa các hàng truy vấn và toàn bộ tập embedding theo từng khối.
+# Khi symmetric=True (truy vấn chính là toàn bộ tập), chỉ duyệt các khối phía trên đường chéo.
+def iter_similarity_blocks(queries, gallery, block_size, symmetric=False):
+    for row_start in range(0, len(queries), block_size):
+        query_block = queries[row_start:row_start + block_size]
+        col_begin = row_start if symmetric else 0
+        for col_start in range(col_begin, len(gallery), block_size):
+            yield row_start, col_start, query_block @ gallery[col_start:col_start + block_size].T
+
+# Kiểm tra trùng lặp giữa các MSSV và bản ghi bất thường trong cùng MSSV
+def audit_gallery(gallery, query_indices=None, duplicate_threshold=DUPLICATE_THRESHOLD,
+                  outlier_threshold=OUTLIER_THRESHOLD, ram_budget_mb=RAM_BUDGET_MB):
+    symmetric = query_indices is None
+    if symmetric:
+        query_indices = np.arange(len(gallery))
+    query_indices = np.asarray(query_indices, dtype=np.int64)
+    block_size = block_size_for_budget(ram_budget_mb)
+    queries = gallery.embeddings if symmetric else gallery.embeddings[query_indices]
+    query_codes = gallery.id_codes[query_indices]
+    # Độ tương đồng lớn nhất với bản ghi khác cùng MSSV (-inf nếu MSSV chỉ có một bản ghi)
+    best_same = np.full(len(gallery), -np.inf, dtype=np.float32)
+    duplicates = {}
+    for row_start, col_start, sims in iter_similarity_blocks(queries, gallery.embeddings, block_size, symmetric):
+        rows = query_indices[row_start:row_start + sims.shape[0]]
+        cols = np.arange(col_start, col_start + sims.shape[1])
+        same_id = query_codes[row_start:row_start + sims.shape[0], None] == gallery.id_codes[None, cols]
+        not_self = rows[:, None] != cols[None, :]
+        if symmetric and row_start == col_start:
+            not_self &= np.triu(np.ones(sims.shape, dtype=bool), k=1)
+
+        same_sims = np.where(same_id & not_self, sims, -np.inf)
+        np.maximum.at(best_same, rows, same_sims.max(axis=1))
+        if symmetric:
+            np.maximum.at(best_same, cols, same_sims.max(axis=0))
+
+        r, c = np.nonzero((sims > duplicate_threshold) & ~same_id & not_self)
+        for a, b, sim in zip(rows[r], cols[c], sims[r, c]):
+            duplicates[(min(a, b), max(a, b))] = float(sim)
+
+    outliers = [(int(i), float(best_same[i])) for i in (query_indices if not symmetric else range(len(gallery)))
+                if np.isfinite(best_same[i]) and best_same[i] < outlier_threshold]
+    duplicates = sorted(((a, b, sim) for (a, b), sim in duplicates.items()), key=lambda item: -item[2])
+    return duplicates, outliers
+
+# Ghi báo cáo CSV (utf-8-sig để mở được bằng Excel); mỗi phần tử là (gallery, duplicates, outliers)
+def write_report(findings, report_dir=REPORT_DIR, mode='full'):
+    os.makedirs(report_dir, exist_ok=True)
+    report_path = os.path.join(report_dir, f"audit_{mode}_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv")
+    with open(report_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Loại', 'Record A', 'MSSV A', 'Họ tên A', 'Buổi A', 'Record B', 'MSSV B', 'Họ tên B', 'Buổi B', 'Độ tương đồng'])
+        for gallery, duplicates, outliers in findings:
+            for a, b, sim in duplicates:
+                writer.writerow(['Trùng khuôn mặt khác MSSV',
+                                 gallery.record_ids[a], gallery.ids[a], gallery.names[a], gallery.session_ids[a],
+                                 gallery.record_ids[b], gallery.ids[b], gallery.names[b], gallery.session_ids[b], f"{sim:.3f}"])
+            for i, best in outliers:
+                writer.writerow(['Khác biệt với các ảnh cùng MSSV',
+                                 gallery.record_ids[i], gallery.ids[i], gallery.names[i], gallery.session_ids[i],
+                                 '', '', '', '', f"{best:.3f}"])
+    return report_path
+
+def _get_state(conn, key):
+    row = conn.execute("SELECT value FROM audit_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+# Chạy kiểm tra cho từng phiên bản mô hình (embedding của các mô hình khác nhau không so sánh được)
+def run_audit(incremental=False, db_path=DB_PATH, report_dir=REPORT_DIR, ram_budget_mb=RAM_BUDGET_MB,
+              duplicate_threshold=DUPLICATE_THRESHOLD, outlier_threshold=OUTLIER_THRESHOLD):
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_path)
+    init_audit_tables(conn)
+    last_record_id = int(_get_state(conn, 'last_record_id') or 0) if incremental else 0
+    model_versions = [row[0] for row in conn.execute("SELECT DISTINCT model_version FROM students").fetchall()]
+    conn.close()
+
+    findings = []
+    max_record_id = last_record_id
+    for model_version in model_versions:
+        gallery = load_gallery(model_version, db_path)
+        if len(gallery) == 0:
+            continue
+        max_record_id = max(max_record_id, int(gallery.record_ids.max()))
+        query_indices = np.nonzero(gallery.record_ids > last_record_id)[0] if incremental else None
+        if query_indices is not None and len(query_indices) == 0:
+            continue
+        duplicates, outliers = audit_gallery(gallery, query_indices, duplicate_threshold, outlier_threshold, ram_budget_mb)
+        if duplicates or outliers:
+            findings.append((gallery, duplicates, outliers))
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO audit_state (key, value) VALUES ('last_record_id', ?)", (str(max_record_id),))
+    conn.close()
+    report_path = write_report(findings, report_dir, 'incremental' if incremental else 'full') if findings else None
+    return report_path, sum(len(d) for _, d, _ in findings), sum(len(o) for _, _, o in findings), time.perf_counter() - start
+
+# Đo thời gian kiểm tra trên tập embedding giả lập
+def benchmark(n_templates=100000, n_new=1000, ram_budget_mb=RAM_BUDGET_MB, seed=0):
+    rng = np.random.default_rng(seed)
+    n_ids = n_templates // 3
+    centers = rng.normal(size=(n_ids, EMBEDDING_DIM)).astype(np.float32)
+    codes = rng.integers(0, n_ids, size=n_templates)
+    embeddings = centers[codes] + rng.normal(scale=0.8, size=(n_templates, EMBEDDING_DIM)).astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1)
+    embeddings /= norms[:, None]
+    gallery = Gallery(np.arange(n_templates, dtype=np.int64), codes.astype(str), codes.astype(str),
+                      np.zeros(n_templates, dtype=np.int64), embeddings, norms)
+
+    start = time.perf_counter()
+    duplicates, outliers = audit_gallery(gallery, ram_budget_mb=ram_budget_mb)
+    full_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    audit_gallery(gallery, np.arange(n_templates - n_new, n_templates), ram_budget_mb=ram_budget_mb)
+    incremental_elapsed = time.perf_counter() - start
+    return {
+        'templates': n_templates,
+        'block_size': block_size_for_budget(ram_budget_mb),
+        'full_seconds': full_elapsed,
+        'pairs_per_second': n_templates * (n_templates - 1) / 2 / full_elapsed,
+        'incremental_new': n_new,
+        'incremental_seconds': incremental_elapsed,
+        'duplicates': len(duplicates),
+        'outliers': len(outliers),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Kiểm tra khuôn mặt trùng lặp giữa các MSSV và bản ghi bất thường trong cùng MSSV")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--report-dir', default=REPORT_DIR)
+    parser.add_argument('--budget-mb', type=int, default=RAM_BUDGET_MB, help="Giới hạn bộ nhớ cho các khối tính toán (MB)")
+    parser.add_argument('--duplicate-threshold', type=float, default=DUPLICATE_THRESHOLD)
+    parser.add_argument('--outlier-threshold', type=float, default=OUTLIER_THRESHOLD)
+    parser.add_argument('--incremental', action='store_true', help="Chỉ kiểm tra các bản ghi mới kể từ lần chạy trước")
+    parser.add_argument('--bench', type=int, metavar='N', help="Đo thời gian trên N embedding giả lập thay vì dữ liệu thật")
+    args = parser.parse_args()
+
+    if args.bench:
+        result = benchmark(args.bench, ram_budget_mb=args.budget_mb)
+        print(f"{result['templates']} embedding, khối {result['block_size']}x{result['block_size']}")
+        print(f"Kiểm tra toàn bộ: {result['full_seconds']:.1f}s ({result['pairs_per_second'] / 1e6:.0f} triệu cặp/s)")
+        print(f"Kiểm tra {result['incremental_new']} bản ghi mới: {result['incremental_seconds']:.2f}s")
+    else:
+        report_path, n_duplicates, n_outliers, elapsed = run_audit(args.incremental, args.db, args.report_dir, args.budget_mb,
+                                                                   args.duplicate_threshold, args.outlier_threshold)
+        print(f"Hoàn tất trong {elapsed:.1f}s: {n_duplicates} cặp trùng khác MSSV, {n_outliers} bản ghi bất thường.")
+        if report_path:
+            print(f"Báo cáo: {report_path}")
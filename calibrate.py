@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from audit import DB_PATH, RAM_BUDGET_MB, EMBEDDING_DIM, Gallery, load_gallery, block_size_for_budget, iter_similarity_blocks
+
+MATCH_CONFIG_PATH = 'match_config.json'
+# Điểm vận hành mặc định: khoảng cách Euclid trên embedding chưa chuẩn hóa (giá trị ban đầu của ứng dụng)
+DEFAULT_MATCH_CONFIG = {'metric': 'l2', 'threshold': 20.0}
+REPORT_DIR = 'calibration_report'
+TARGET_FPIR = 0.01
+GALLERY_SIZES = [50, 100, 200, 500, 1000, 2000, 5000, 10000]
+COS_BINS = 4000
+L2_BINS = 4000
+
+# Đọc điểm vận hành (độ đo và ngưỡng) mà ứng dụng dùng để so khớp khuôn mặt
+def load_match_config(path=MATCH_CONFIG_PATH):
+    config = dict(DEFAULT_MATCH_CONFIG)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            config.update(json.load(f))
+    if config['metric'] not in ('l2', 'cosine'):
+        raise ValueError(f"Độ đo không hợp lệ trong {path}: {config['metric']}")
+    config['threshold'] = float(config['threshold'])
+    return config
+
+def save_match_config(config, path=MATCH_CONFIG_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+# Phân bố điểm của các cặp cùng MSSV (genuine) và khác MSSV (impostor), lưu dưới dạng histogram
+class ScoreDistributions:
+    def __init__(self, l2_max):
+        self.l2_max = l2_max
+        self.cos_edges = np.linspace(-1.0, 1.0, COS_BINS + 1)
+        self.l2_edges = np.linspace(0.0, l2_max, L2_BINS + 1)
+        self.genuine_cos = np.zeros(COS_BINS, dtype=np.int64)
+        self.impostor_cos = np.zeros(COS_BINS, dtype=np.int64)
+        self.genuine_l2 = np.zeros(L2_BINS, dtype=np.int64)
+        self.impostor_l2 = np.zeros(L2_BINS, dtype=np.int64)
+
+    def add(self, sims, l2, same_id, valid):
+        cos_idx = np.clip(((sims + 1.0) * (COS_BINS / 2.0)).astype(np.int32), 0, COS_BINS - 1)
+        l2_idx = np.clip((l2 * (L2_BINS / self.l2_max)).astype(np.int32), 0, L2_BINS - 1)
+        genuine = same_id & valid
+        impostor = ~same_id & valid
+        self.genuine_cos += np.bincount(cos_idx[genuine], minlength=COS_BINS)
+        self.impostor_cos += np.bincount(cos_idx[impostor], minlength=COS_BINS)
+        self.genuine_l2 += np.bincount(l2_idx[genuine], minlength=L2_BINS)
+        self.impostor_l2 += np.bincount(l2_idx[impostor], minlength=L2_BINS)
+
+    # FMR/FNMR theo từng ngưỡng: cosine chấp nhận khi điểm >= ngưỡng, L2 chấp nhận khi khoảng cách < ngưỡng
+    def curves(self, metric):
+        if metric == 'cosine':
+            genuine, impostor, thresholds = self.genuine_cos, self.impostor_cos, self.cos_edges[:-1]
+            fmr = impostor[::-1].cumsum()[::-1] / max(impostor.sum(), 1)
+            fnmr = np.concatenate(([0], genuine.cumsum()[:-1])) / max(genuine.sum(), 1)
+        else:
+            genuine, impostor, thresholds = self.genuine_l2, self.impostor_l2, self.l2_edges[1:]
+            fmr = impostor.cumsum() / max(impostor.sum(), 1)
+            fnmr = np.concatenate((genuine[::-1].cumsum()[::-1][1:], [0])) / max(genuine.sum(), 1)
+        return thresholds, fmr, fnmr
+
+# Tính phân bố điểm trên toàn bộ các cặp embedding theo từng khối
+def compute_distributions(gallery, ram_budget_mb=RAM_BUDGET_MB):
+    l2_max = float(2 * gallery.norms.max()) if len(gallery) else 1.0
+    distributions = ScoreDistributions(max(l2_max, 1e-6))
+    # Mỗi phần tử khối cần thêm bộ nhớ cho khoảng cách L2 và chỉ số bin
+    block_size = block_size_for_budget(ram_budget_mb, bytes_per_element=40)
+    norms = gallery.norms.astype(np.float32)
+    for row_start, col_start, sims in iter_similarity_blocks(gallery.embeddings, gallery.embeddings, block_size, symmetric=True):
+        rows = slice(row_start, row_start + sims.shape[0])
+        cols = slice(col_start, col_start + sims.shape[1])
+        same_id = gallery.id_codes[rows, None] == gallery.id_codes[None, cols]
+        if row_start == col_start:
+            valid = np.triu(np.ones(sims.shape, dtype=bool), k=1)
+        else:
+            valid = np.ones(sims.shape, dtype=bool)
+        # |a - b|^2 = |a|^2 + |b|^2 - 2|a||b|cos(a, b)
+        l2 = norms[rows, None] ** 2 + norms[None, cols] ** 2 - 2 * norms[rows, None] * norms[None, cols] * sims
+        np.sqrt(np.maximum(l2, 0, out=l2), out=l2)
+        distributions.add(sims, l2, same_id, valid)
+    return distributions
+
+# Ngưỡng được đề xuất cho từng kích thước tập đăng ký, sao cho tỉ lệ nhận nhầm khi tìm kiếm (FPIR) không vượt mục tiêu
+def recommend_thresholds(distributions, gallery_sizes=GALLERY_SIZES, target_fpir=TARGET_FPIR):
+    recommendations = []
+    for gallery_size in gallery_sizes:
+        # FPIR ~ 1 - (1 - FMR)^N với N là số người trong tập đăng ký
+        required_fmr = 1 - (1 - target_fpir) ** (1.0 / gallery_size)
+        row = {'gallery_size': gallery_size, 'required_fmr': required_fmr}
+        for metric in ('cosine', 'l2'):
+            thresholds, fmr, fnmr = distributions.curves(metric)
+            ok = np.nonzero(fmr <= required_fmr)[0]
+            if len(ok) == 0:
+                row[metric] = None
+                continue
+            k = ok[0] if metric == 'cosine' else ok[-1]
+            row[metric] = {'threshold': float(thresholds[k]), 'fmr': float(fmr[k]), 'fnmr': float(fnmr[k])}
+        recommendations.append(row)
+    return recommendations
+
+def equal_error_rate(distributions, metric):
+    thresholds, fmr, fnmr = distributions.curves(metric)
+    k = int(np.argmin(np.abs(fmr - fnmr)))
+    return float((fmr[k] + fnmr[k]) / 2), float(thresholds[k])
+
+# Vẽ đường ROC và DET (dùng altair, lưu thành file HTML)
+def plot_curves(distributions, output_path):
+    import altair as alt
+    import pandas as pd
+
+    frames = []
+    for metric in ('cosine', 'l2'):
+        _, fmr, fnmr = distributions.curves(metric)
+        keep = (fmr > 0) & (fnmr > 0)
+        frames.append(pd.DataFrame({'Độ đo': metric, 'FMR': fmr[keep], 'FNMR': fnmr[keep], 'TMR': 1 - fnmr[keep]}))
+    df = pd.concat(frames)
+    roc = alt.Chart(df).mark_line().encode(
+        x=alt.X('FMR', scale=alt.Scale(type='log')), y='TMR', color='Độ đo'
+    ).properties(title='ROC', width=400, height=300)
+    det = alt.Chart(df).mark_line().encode(
+        x=alt.X('FMR', scale=alt.Scale(type='log')), y=alt.Y('FNMR', scale=alt.Scale(type='log')), color='Độ đo'
+    ).properties(title='DET', width=400, height=300)
+    (roc | det).save(output_path)
+    return output_path
+
+# Chọn phiên bản mô hình có nhiều embedding nhất
+def most_common_model_version(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT model_version, COUNT(*) AS n FROM students GROUP BY model_version ORDER BY n DESC LIMIT 1").fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def synthetic_gallery(n_templates, seed=0):
+    rng = np.random.default_rng(seed)
+    n_ids = max(1, n_templates // 3)
+    centers = rng.normal(size=(n_ids, EMBEDDING_DIM)).astype(np.float32)
+    codes = rng.integers(0, n_ids, size=n_templates)
+    raw = (centers[codes] + rng.normal(scale=0.8, size=(n_templates, EMBEDDING_DIM)).astype(np.float32)) * 1.2
+    norms = np.linalg.norm(raw, axis=1)
+    return Gallery(np.arange(n_templates, dtype=np.int64), codes.astype(str), codes.astype(str),
+                   np.zeros(n_templates, dtype=np.int64), raw / norms[:, None], norms)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đánh giá và hiệu chỉnh ngưỡng so khớp khuôn mặt")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--model-version', help="Mặc định: phiên bản mô hình có nhiều embedding nhất")
+    parser.add_argument('--budget-mb', type=int, default=RAM_BUDGET_MB)
+    parser.add_argument('--target-fpir', type=float, default=TARGET_FPIR)
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=GALLERY_SIZES)
+    parser.add_argument('--report-dir', default=REPORT_DIR)
+    parser.add_argument('--bench', type=int, metavar='N', help="Dùng N embedding giả lập thay vì dữ liệu thật")
+    parser.add_argument('--write-config', action='store_true', help="Ghi điểm vận hành được chọn vào file cấu hình của ứng dụng")
+    parser.add_argument('--metric', choices=['l2', 'cosine'], default='l2')
+    parser.add_argument('--gallery-size', type=int, help="Kích thước tập đăng ký dùng để chọn ngưỡng khi --write-config")
+    parser.add_argument('--config', default=MATCH_CONFIG_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.bench:
+        gallery = synthetic_gallery(args.bench)
+    else:
+        gallery = load_gallery(args.model_version or most_common_model_version(args.db), args.db)
+    if len(gallery) < 2:
+        parser.error("Cần ít nhất hai embedding để đánh giá")
+    load_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    distributions = compute_distributions(gallery, args.budget_mb)
+    compute_elapsed = time.perf_counter() - start
+    n_genuine = int(distributions.genuine_cos.sum())
+    n_impostor = int(distributions.impostor_cos.sum())
+    print(f"{len(gallery)} embedding, {n_genuine} cặp cùng MSSV, {n_impostor} cặp khác MSSV")
+    print(f"Đọc dữ liệu: {load_elapsed:.2f}s, tính phân bố: {compute_elapsed:.2f}s")
+    for metric in ('cosine', 'l2'):
+        eer, threshold = equal_error_rate(distributions, metric)
+        print(f"EER ({metric}): {eer:.4f} tại ngưỡng {threshold:.3f}")
+
+    recommendations = recommend_thresholds(distributions, args.gallery_sizes, args.target_fpir)
+    print(f"\nNgưỡng đề xuất (FPIR mục tiêu {args.target_fpir:.2%}):")
+    print(f"{'Số người':>9} {'FMR cần':>10} {'cosine >=':>10} {'FNMR':>8} {'L2 <':>8} {'FNMR':>8}")
+    for row in recommendations:
+        cells = []
+        for metric, precision in (('cosine', 3), ('l2', 2)):
+            point = row[metric]
+            cells.append(f"{point['threshold']:.{precision}f}" if point else '--')
+            cells.append(f"{point['fnmr']:.4f}" if point else '--')
+        print(f"{row['gallery_size']:>9} {row['required_fmr']:>10.2e} {cells[0]:>10} {cells[1]:>8} {cells[2]:>8} {cells[3]:>8}")
+
+    os.makedirs(args.report_dir, exist_ok=True)
+    with open(os.path.join(args.report_dir, 'recommendations.json'), 'w', encoding='utf-8') as f:
+        json.dump(recommendations, f, ensure_ascii=False, indent=2)
+    try:
+        print(f"\nBiểu đồ ROC/DET: {plot_curves(distributions, os.path.join(args.report_dir, 'roc_det.html'))}")
+    except ImportError:
+        print("\nKhông có altair, bỏ qua biểu đồ ROC/DET.")
+
+    if args.write_config:
+        if args.gallery_size is None:
+            parser.error("--gallery-size là bắt buộc với --write-config")
+        row = recommend_thresholds(distributions, [args.gallery_size], args.target_fpir)[0]
+        if row[args.metric] is None:
+            parser.error("Không tìm được ngưỡng thỏa mãn FPIR mục tiêu cho kích thước tập đăng ký này")
+        config = {'metric': args.metric, 'threshold': row[args.metric]['threshold'],
+                  'gallery_size': args.gallery_size, 'target_fpir': args.target_fpir}
+        save_match_config(config, args.config)
+        print(f"Đã ghi cấu hình vào {args.config}: {config}")
@@ -0,0 +1,239 @@
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+import pytz
+from PIL import Image
+
+from attendance_flow import load_embeddings_by_session
+from calibrate import load_match_config
+from face_chips import extract_chip, save_chip
+
+DB_PATH = 'attendance.db'
+IMAGE_DIR = 'student_images'
+BURST_SECONDS = 4.0
+BURST_DEBOUNCE_MS = 200
+MAX_TEMPLATES = 5
+MIN_QUALITY = 0.35
+# Phương sai Laplacian của ảnh khuôn mặt 112x112 được coi là đủ nét
+SHARPNESS_REF = 150.0
+# Cạnh ngắn của khung khuôn mặt (pixel) được coi là đủ lớn
+FACE_SIZE_REF = 160.0
+# Hai khung hình có khoảng cách cosine nhỏ hơn mức này được coi là trùng nhau
+MIN_DIVERSITY = 0.02
+
+# Thiết lập múi giờ Việt Nam (UTC+7)
+tz = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Độ nét của ảnh khuôn mặt: phương sai của Laplacian trên ảnh xám
+def sharpness(chip):
+    gray = cv2.cvtColor(np.ascontiguousarray(chip), cv2.COLOR_RGB2GRAY)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+# Điểm chất lượng trong [0, 1]: độ tin cậy phát hiện x độ nét x kích thước khuôn mặt
+def quality_score(face, chip):
+    x1, y1, x2, y2 = face.bbox
+    size_factor = min(1.0, min(x2 - x1, y2 - y1) / FACE_SIZE_REF)
+    sharpness_factor = min(1.0, sharpness(chip) / SHARPNESS_REF)
+    return float(face.det_score) * sharpness_factor * size_factor
+
+# Một khung hình có đúng một khuôn mặt thu được trong lúc chụp liên tiếp
+class BurstCandidate:
+    def __init__(self, frame, face, chip, quality, captured_at):
+        self.frame = frame
+        self.face = face
+        self.chip = chip
+        self.quality = quality
+        self.captured_at = captured_at
+
+# Thu thập khung hình từ camera trực tiếp, mỗi lần chạy lại script xử lý một khung hình
+class BurstCollector:
+    def __init__(self, duration=BURST_SECONDS):
+        self.duration = duration
+        self.started_at = None
+        self.last_frame_at = None
+        self.frames = 0
+        self.detect_seconds = 0.0
+        self.candidates = []
+
+    def add_frame(self, recognizer, img_array):
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        self.last_frame_at = time.perf_counter()
+        self.frames += 1
+        start = time.perf_counter()
+        face = recognizer.get_face(img_array)
+        if face is None:
+            self.detect_seconds += time.perf_counter() - start
+            return None
+        chip = extract_chip(img_array, face)
+        candidate = BurstCandidate(img_array, face, chip, quality_score(face, chip), self.elapsed())
+        self.detect_seconds += time.perf_counter() - start
+        self.candidates.append(candidate)
+        return candidate
+
+    def elapsed(self):
+        return 0.0 if self.started_at is None else time.perf_counter() - self.started_at
+
+    # Thời gian đã thu thập (đến khung hình cuối cùng)
+    def collection_seconds(self):
+        return 0.0 if self.started_at is None else self.last_frame_at - self.started_at
+
+    def is_done(self):
+        return self.started_at is not None and self.elapsed() >= self.duration
+
+def _normalized(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
+
+# Chọn tối đa k ảnh mẫu đa dạng: bắt đầu từ khung hình chất lượng cao nhất, lần lượt thêm
+# khung hình đạt ngưỡng chất lượng xa nhất (theo khoảng cách cosine) với các ảnh mẫu đã chọn
+def select_diverse_templates(candidates, k=MAX_TEMPLATES, min_quality=MIN_QUALITY):
+    if not candidates:
+        return []
+    qualities = np.array([candidate.quality for candidate in candidates])
+    eligible = np.flatnonzero(qualities >= min_quality)
+    if len(eligible) == 0:
+        eligible = np.array([int(np.argmax(qualities))])
+    embeddings = _normalized([candidates[i].face.embedding for i in eligible])
+    first = int(np.argmax(qualities[eligible]))
+    selected = [first]
+    min_distance = 1.0 - embeddings @ embeddings[first]
+    while len(selected) < min(k, len(eligible)):
+        min_distance[selected] = -1.0
+        farthest = int(np.argmax(min_distance))
+        if min_distance[farthest] < MIN_DIVERSITY:
+            break
+        selected.append(farthest)
+        min_distance = np.minimum(min_distance, 1.0 - embeddings @ embeddings[farthest])
+    return [int(eligible[i]) for i in selected]
+
+# Biên so khớp của các khung hình thử với một tập ảnh mẫu, theo độ đo của điểm vận hành:
+# biên ngưỡng = khoảng cách từ điểm khớp nhất đến ngưỡng, biên nhầm lẫn = khoảng cách đến
+# sinh viên khác gần nhất (dương là an toàn)
+def match_margins(templates, probes, impostors, match_config):
+    templates = np.asarray(templates, dtype=np.float32)
+    probes = np.asarray(probes, dtype=np.float32)
+    if len(probes) == 0:
+        return None
+
+    def best_scores(gallery):
+        gallery = np.asarray(gallery, dtype=np.float32)
+        if match_config['metric'] == 'cosine':
+            return (_normalized(probes) @ _normalized(gallery).T).max(axis=1)
+        return np.linalg.norm(probes[:, None, :] - gallery[None, :, :], axis=2).min(axis=1)
+
+    genuine = best_scores(templates)
+    sign = 1.0 if match_config['metric'] == 'cosine' else -1.0
+    threshold_margins = sign * (genuine - match_config['threshold'])
+    result = {
+        'probes': len(probes),
+        'genuine_mean': float(genuine.mean()),
+        'threshold_margin_mean': float(threshold_margins.mean()),
+        'threshold_margin_min': float(threshold_margins.min()),
+        'accepted': int((threshold_margins > 0).sum()),
+    }
+    if len(impostors):
+        impostor_margins = sign * (genuine - best_scores(impostors))
+        result['impostor_margin_mean'] = float(impostor_margins.mean())
+        result['impostor_margin_min'] = float(impostor_margins.min())
+    return result
+
+# So sánh ảnh mẫu chọn từ chuỗi khung hình với đăng ký một ảnh (khung hình đầu tiên có khuôn mặt,
+# như ảnh chụp bằng st.camera_input). Cả hai cách được đánh giá trên cùng các khung hình không dùng
+# làm ảnh mẫu trong cách nào; None nếu không còn khung hình nào để đánh giá.
+def compare_with_single_shot(candidates, selected, impostors, match_config):
+    embeddings = [candidate.face.embedding for candidate in candidates]
+    held_out = set(selected) | {0}
+    probes = [embeddings[i] for i in range(len(embeddings)) if i not in held_out]
+
+    def evaluate(template_indices):
+        return match_margins([embeddings[i] for i in template_indices], probes, impostors, match_config)
+
+    return {'single_shot': evaluate([0]), 'burst': evaluate(selected)}
+
+# Lưu các ảnh mẫu đã chọn của một sinh viên (bản ghi, ảnh khuôn mặt) trong cùng một transaction
+def save_burst_templates(student_id, name, session_id, candidates, recognizer, db_path=DB_PATH, image_dir=IMAGE_DIR):
+    os.makedirs(image_dir, exist_ok=True)
+    timestamp = datetime.now(tz).strftime('%Y%m%d%H%M%S')
+    image_paths = []
+    for i, candidate in enumerate(candidates):
+        image_path = f"{image_dir}/{student_id}_{name}_{timestamp}_{i}.jpg"
+        Image.fromarray(candidate.frame).save(image_path)
+        image_paths.append(image_path)
+    conn = sqlite3.connect(db_path)
+    record_ids = []
+    try:
+        with conn:
+            for candidate, image_path in zip(candidates, image_paths):
+                cursor = conn.execute("INSERT INTO students (id, name, embedding, image_path, session_id, model_name, model_version) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      (student_id, name, candidate.face.embedding.tobytes(), image_path, session_id,
+                                       recognizer.model_name, recognizer.model_version))
+                record_ids.append(cursor.lastrowid)
+                save_chip(conn, cursor.lastrowid, session_id, candidate.chip, candidate.face.kps, commit=False)
+    except Exception:
+        # Ô ảnh khuôn mặt đã ghi vào file sẽ không còn được tham chiếu; chỉ cần xóa ảnh gốc
+        for image_path in image_paths:
+            if os.path.exists(image_path):
+                os.remove(image_path)
+        raise
+    finally:
+        conn.close()
+    return record_ids
+
+# Chạy thử đăng ký liên tiếp trên một video (giả lập camera trực tiếp) và in báo cáo
+def benchmark(video_path, student_id, session_id, db_path=DB_PATH, duration=BURST_SECONDS, fps=1000 / BURST_DEBOUNCE_MS):
+    from recognizer import FaceRecognizer
+    recognizer = FaceRecognizer()
+    match_config = load_match_config()
+    capture = cv2.VideoCapture(video_path)
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, int(round(video_fps / fps)))
+    collector = BurstCollector(duration)
+    index = 0
+    while True:
+        ok, frame = capture.read()
+        if not ok or index / video_fps >= duration:
+            break
+        if index % step == 0:
+            collector.add_frame(recognizer, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        index += 1
+    capture.release()
+
+    start = time.perf_counter()
+    selected = select_diverse_templates(collector.candidates)
+    select_seconds = time.perf_counter() - start
+    _, ids, _, embeddings = load_embeddings_by_session(session_id, db_path)
+    impostors = [embedding for id_, embedding in zip(ids, embeddings) if id_ != student_id]
+    report = compare_with_single_shot(collector.candidates, selected, impostors, match_config) if selected else {}
+    return {'frames': collector.frames, 'faces': len(collector.candidates), 'selected': selected,
+            'detect_seconds': collector.detect_seconds, 'select_seconds': select_seconds,
+            'qualities': [collector.candidates[i].quality for i in selected], 'report': report}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đánh giá đăng ký nhiều khung hình so với đăng ký một ảnh")
+    parser.add_argument('--video', required=True, help="Video khuôn mặt của một sinh viên")
+    parser.add_argument('--student-id', required=True, help="MSSV của sinh viên trong video (loại khỏi tập so sánh)")
+    parser.add_argument('--session-id', type=int, required=True, help="Buổi thực tập dùng làm tập sinh viên khác")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--duration', type=float, default=BURST_SECONDS)
+    args = parser.parse_args()
+
+    result = benchmark(args.video, args.student_id, args.session_id, args.db, args.duration)
+    print(f"Khung hình: {result['frames']}, có khuôn mặt: {result['faces']}, ảnh mẫu đã chọn: {len(result['selected'])}")
+    print(f"Thời gian phát hiện: {result['detect_seconds']:.2f} s, chọn ảnh mẫu: {result['select_seconds'] * 1000:.1f} ms")
+    print("Chất lượng ảnh mẫu: " + ", ".join(f"{q:.2f}" for q in result['qualities']))
+    for mode, label in [('single_shot', "Một ảnh"), ('burst', "Nhiều khung hình")]:
+        margins = result['report'].get(mode)
+        if margins is None:
+            print(f"{label}: không đủ khung hình để đánh giá")
+            continue
+        line = (f"{label}: {margins['accepted']}/{margins['probes']} khung hình được chấp nhận, "
+                f"biên ngưỡng TB {margins['threshold_margin_mean']:.3f} (nhỏ nhất {margins['threshold_margin_min']:.3f})")
+        if 'impostor_margin_mean' in margins:
+            line += f", biên nhầm lẫn TB {margins['impostor_margin_mean']:.3f} (nhỏ nhất {margins['impostor_margin_min']:.3f})"
+        print(line)
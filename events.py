@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque
+
+REPLAY_SIZE = 500
+SUBSCRIBER_QUEUE_SIZE = 1000
+EVENT_LOG_PATH = 'attendance_events.jsonl'
+# Khi file sự kiện vượt quá kích thước này, nó được đổi tên thành .1 (.1 thành .2, ...) và giữ tối đa EVENT_LOG_BACKUPS file cũ
+EVENT_LOG_MAX_BYTES = 10 * 2**20
+EVENT_LOG_BACKUPS = 3
+
+# Hàng đợi sự kiện của một người theo dõi. Khi hàng đợi đầy, sự kiện cũ nhất bị bỏ
+# (người gửi không bao giờ bị chặn) và dropped tăng lên để người theo dõi biết cần đồng bộ lại.
+class Subscription:
+    def __init__(self, bus, session_id=None, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.session_id = session_id
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._bus = weakref.ref(bus)
+
+    def _offer(self, event):
+        if self.session_id is not None and event.get('session_id') != self.session_id:
+            return
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    # Lấy một sự kiện, chờ tối đa timeout giây; trả về None nếu không có
+    def get(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # Lấy tất cả sự kiện đang chờ mà không chặn
+    def poll(self):
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        bus = self._bus()
+        if bus is not None:
+            bus.unsubscribe(self)
+
+# Bus sự kiện publish/subscribe trong tiến trình, có bộ đệm phát lại cho người theo dõi đến sau
+# và (tùy chọn) ghi mỗi sự kiện thành một dòng JSON để công cụ khác theo dõi (tail -F)
+class EventBus:
+    def __init__(self, replay_size=REPLAY_SIZE, sink_path=None, sink_max_bytes=EVENT_LOG_MAX_BYTES, sink_backups=EVENT_LOG_BACKUPS):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._replay = deque(maxlen=replay_size)
+        # Người theo dõi bị thu hồi (phiên trình duyệt đã đóng) tự động rời khỏi bus
+        self._subscribers = weakref.WeakSet()
+        self.sink_path = sink_path
+        self.sink_max_bytes = sink_max_bytes
+        self.sink_backups = sink_backups
+        self.sink_errors = 0
+
+    def set_sink(self, sink_path, max_bytes=EVENT_LOG_MAX_BYTES, backups=EVENT_LOG_BACKUPS):
+        with self._lock:
+            self.sink_path = sink_path
+            self.sink_max_bytes = max_bytes
+            self.sink_backups = backups
+
+    # Gọi khi đang giữ khóa. Đổi tên file sự kiện nếu ghi thêm line sẽ vượt quá sink_max_bytes
+    def _rotate_sink(self, line_bytes):
+        if not self.sink_max_bytes:
+            return
+        try:
+            size = os.path.getsize(self.sink_path)
+        except OSError:
+            return
+        if size == 0 or size + line_bytes <= self.sink_max_bytes:
+            return
+        if self.sink_backups <= 0:
+            os.remove(self.sink_path)
+            return
+        for i in range(self.sink_backups - 1, 0, -1):
+            if os.path.exists(f"{self.sink_path}.{i}"):
+                os.replace(f"{self.sink_path}.{i}", f"{self.sink_path}.{i + 1}")
+        os.replace(self.sink_path, f"{self.sink_path}.1")
+
+    def publish(self, event_type, **data):
+        with self._lock:
+            self._seq += 1
+            event = {'seq': self._seq, 'type': event_type, 'published_at': time.time(), **data}
+            self._replay.append(event)
+            subscribers = list(self._subscribers)
+            if self.sink_path:
+                line = (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8')
+                try:
+                    self._rotate_sink(len(line))
+                    with open(self.sink_path, 'ab') as f:
+                        f.write(line)
+                except OSError:
+                    self.sink_errors += 1
+        for subscriber in subscribers:
+            subscriber._offer(event)
+        return event
+
+    # Đăng ký theo dõi (chỉ một buổi thực tập nếu có session_id); replay=True nhận lại các sự kiện gần đây
+    def subscribe(self, session_id=None, replay=True, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        subscription = Subscription(self, session_id, queue_size)
+        with self._lock:
+            if replay:
+                for event in self._replay:
+                    subscription._offer(event)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+# Bus dùng chung trong tiến trình; ứng dụng bật ghi file bằng event_bus.set_sink(EVENT_LOG_PATH)
+event_bus = EventBus()
+
+# Đếm câu lệnh SQL của mọi kết nối mở trong khối with, phân loại theo bảng đọc/ghi chính
+class _QueryCounter:
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._connect = sqlite3.connect
+
+    def _trace(self, statement):
+        words = statement.split()
+        kind = words[0].upper() if words else ''
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def __enter__(self):
+        def connect(*args, **kwargs):
+            conn = self._connect(*args, **kwargs)
+            conn.set_trace_callback(self._trace)
+            return conn
+        sqlite3.connect = connect
+        return self
+
+    def __exit__(self, *exc):
+        sqlite3.connect = self._connect
+
+    def total(self):
+        return sum(self.counts.values())
+
+# Giả lập 200 sinh viên điểm danh trong duration giây (thời gian ảo) với n_viewers người theo dõi:
+# không có bus, mỗi người theo dõi chạy lại truy vấn danh sách điểm danh sau mỗi refresh giây;
+# có bus, mỗi người theo dõi chỉ truy vấn một lần rồi cập nhật từ sự kiện
+def benchmark(n_students=200, n_viewers=5, duration=600.0, refresh=2.0, extra_students=5000):
+    from attendance_flow import get_attendance_list, process_attendance_frame
+    from calibrate import DEFAULT_MATCH_CONFIG
+    from loadtest import StubRecognizer, create_synthetic_db, make_frame, EMBEDDING_DIM
+    import numpy as np
+
+    results = {}
+    for use_bus in (False, True):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'events.db')
+            embeddings = create_synthetic_db(db_path, n_students)
+            # Sinh viên của các buổi khác làm bảng students lớn như trên hệ thống thật
+            conn = sqlite3.connect(db_path)
+            filler = np.zeros(EMBEDDING_DIM, dtype=np.float32).tobytes()
+            conn.executemany("INSERT INTO students (id, name, embedding, session_id) VALUES (?, ?, ?, 2)",
+                             [(f"OT{i:05d}", f"Sinh viên khác {i}", filler) for i in range(extra_students)])
+            conn.commit()
+            conn.row_factory = sqlite3.Row
+            session_info = conn.execute("SELECT * FROM sessions WHERE id = 1").fetchone()
+            conn.close()
+            recognizer = StubRecognizer(embeddings, latency_ms=0.0, jitter_ms=0.0)
+            gallery = ([i + 1 for i in range(n_students)], [f"SV{i:05d}" for i in range(n_students)],
+                       [f"Sinh viên {i}" for i in range(n_students)], embeddings)
+            bus = EventBus()
+            arrivals = np.sort(np.random.default_rng(0).uniform(0, duration, n_students))
+            viewers = []
+            dashboard_seconds = 0.0
+            with _QueryCounter() as counter:
+                if use_bus:
+                    for _ in range(n_viewers):
+                        subscription = bus.subscribe(session_id=1)
+                        start = time.perf_counter()
+                        seen = {row[0] for row in get_attendance_list(1, db_path)}
+                        dashboard_seconds += time.perf_counter() - start
+                        viewers.append((subscription, seen))
+                flow_queries = 0
+                next_refresh = 0.0
+                for index, arrival in enumerate(arrivals):
+                    while not use_bus and next_refresh <= arrival:
+                        start = time.perf_counter()
+                        for _ in range(n_viewers):
+                            get_attendance_list(1, db_path)
+                        dashboard_seconds += time.perf_counter() - start
+                        next_refresh += refresh
+                    before = counter.total()
+                    process_attendance_frame(recognizer, make_frame(index), 1, session_info, gallery,
+                                             DEFAULT_MATCH_CONFIG, db_path, bus=bus)
+                    flow_queries += counter.total() - before
+                    if use_bus:
+                        start = time.perf_counter()
+                        for subscription, seen in viewers:
+                            seen.update(event['student_id'] for event in subscription.poll())
+                        dashboard_seconds += time.perf_counter() - start
+            results['bus' if use_bus else 'polling'] = {
+                'queries': counter.total(), 'flow_queries': flow_queries,
+                'dashboard_queries': counter.total() - flow_queries, 'dashboard_seconds': dashboard_seconds,
+                'complete': all(len(seen) == n_students for _, seen in viewers) if use_bus else True,
+            }
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đo số truy vấn cơ sở dữ liệu khi theo dõi điểm danh có và không có bus sự kiện")
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--viewers', type=int, default=5, help="Số người đang xem bảng theo dõi")
+    parser.add_argument('--duration', type=float, default=600.0, help="Thời gian điểm danh giả lập (giây)")
+    parser.add_argument('--refresh', type=float, default=2.0, help="Chu kỳ tải lại khi không có bus (giây)")
+    parser.add_argument('--extra-students', type=int, default=5000, help="Số bản ghi sinh viên của các buổi khác")
+    args = parser.parse_args()
+    results = benchmark(args.students, args.viewers, args.duration, args.refresh, args.extra_students)
+    print(f"{'Chế độ':>8} {'Tổng truy vấn':>14} {'Điểm danh':>10} {'Theo dõi':>9} {'Thời gian theo dõi (ms)':>24}")
+    for mode, result in results.items():
+        print(f"{mode:>8} {result['queries']:>14} {result['flow_queries']:>10} {result['dashboard_queries']:>9} "
+              f"{result['dashboard_seconds'] * 1000:>24.1f}")
+    if not results['bus']['complete']:
+        print("Cảnh báo: có người theo dõi không nhận đủ sự kiện.")
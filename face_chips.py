@@ -0,0 +1,210 @@
+import argparse
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+from insightface.utils import face_align
+
+DB_PATH = 'attendance.db'
+CHIP_DIR = 'face_chips'
+CHIP_SIZE = 112
+CHIP_SHAPE = (CHIP_SIZE, CHIP_SIZE, 3)
+CHIP_BYTES = CHIP_SIZE * CHIP_SIZE * 3
+EMBED_BATCH_SIZE = 64
+
+# Khóa ghi để hai lần đăng ký đồng thời không ghi đè cùng một vị trí trong file
+_write_lock = threading.Lock()
+
+# Bảng ánh xạ bản ghi sinh viên -> vị trí ảnh khuôn mặt trong file của buổi thực tập,
+# và các vị trí đã được giải phóng (bản ghi bị xóa) để dùng lại khi đăng ký mới
+def init_chip_tables(conn, chip_dir=CHIP_DIR):
+    conn.execute('''CREATE TABLE IF NOT EXISTS face_chips
+                 (record_id INTEGER PRIMARY KEY, session_id INTEGER, slot INTEGER, kps BLOB)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_face_chips_session ON face_chips (session_id, slot)")
+    has_free_slots = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'face_chip_free_slots'").fetchone()
+    conn.execute('''CREATE TABLE IF NOT EXISTS face_chip_free_slots
+                 (session_id INTEGER, slot INTEGER, PRIMARY KEY (session_id, slot))''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS face_chip_slot_freed AFTER DELETE ON face_chips
+                 BEGIN INSERT OR IGNORE INTO face_chip_free_slots (session_id, slot) VALUES (OLD.session_id, OLD.slot); END''')
+    if not has_free_slots:
+        # Ghi nhận các vị trí đã bị bỏ trống trước khi có bảng này
+        used = {}
+        for session_id, slot in conn.execute("SELECT session_id, slot FROM face_chips"):
+            used.setdefault(session_id, set()).add(slot)
+        for chip_file in glob.glob(os.path.join(chip_dir, 'session_*.bin')):
+            session_id = int(os.path.basename(chip_file)[len('session_'):-len('.bin')])
+            n_slots = os.path.getsize(chip_file) // CHIP_BYTES
+            conn.executemany("INSERT OR IGNORE INTO face_chip_free_slots (session_id, slot) VALUES (?, ?)",
+                             [(session_id, slot) for slot in range(n_slots) if slot not in used.get(session_id, set())])
+    conn.commit()
+
+# Mỗi buổi thực tập có một file nhị phân chứa các ảnh 112x112 liên tiếp
+def get_chip_file(session_id, chip_dir=CHIP_DIR):
+    return os.path.join(chip_dir, f"session_{session_id}.bin")
+
+# Cắt và căn chỉnh khuôn mặt theo 5 điểm mốc giống như mô hình nhận diện
+def extract_chip(image, face):
+    chip = face_align.norm_crop(image, landmark=face.kps, image_size=CHIP_SIZE)
+    if chip.ndim == 3 and chip.shape[2] == 4:
+        chip = chip[:, :, :3]  # Loại bỏ kênh alpha
+    return chip
+
+# Lưu ảnh khuôn mặt đã căn chỉnh và điểm mốc của một bản ghi, dùng lại vị trí trống nếu có.
+# Vị trí trống được nhận bằng một câu lệnh ghi nên khóa ghi của cơ sở dữ liệu được giữ từ đây đến khi
+# transaction kết thúc: không kết nối (hay tiến trình) nào khác nhận cùng vị trí hoặc nối thêm vào file cùng lúc.
+# Nếu transaction bị hủy, vị trí vừa nhận vẫn còn trong danh sách trống.
+def save_chip(conn, record_id, session_id, chip, kps, chip_dir=CHIP_DIR, commit=True):
+    chip = np.ascontiguousarray(chip, dtype=np.uint8)
+    if chip.shape != CHIP_SHAPE:
+        raise ValueError(f"Ảnh khuôn mặt phải có kích thước {CHIP_SHAPE}, nhận được {chip.shape}")
+    os.makedirs(chip_dir, exist_ok=True)
+    chip_file = get_chip_file(session_id, chip_dir)
+    # Xóa ảnh cũ của bản ghi trước (nếu có) để vị trí của nó được trả lại danh sách trống
+    conn.execute("DELETE FROM face_chips WHERE record_id = ?", (record_id,))
+    free = conn.execute("""
+        DELETE FROM face_chip_free_slots WHERE session_id = ? AND slot =
+            (SELECT MIN(slot) FROM face_chip_free_slots WHERE session_id = ?)
+        RETURNING slot
+    """, (session_id, session_id)).fetchall()
+    with _write_lock:
+        if free and os.path.exists(chip_file):
+            slot = free[0][0]
+            with open(chip_file, 'r+b') as f:
+                f.seek(slot * CHIP_BYTES)
+                f.write(chip.tobytes())
+        else:
+            with open(chip_file, 'ab') as f:
+                slot = f.tell() // CHIP_BYTES
+                f.write(chip.tobytes())
+    conn.execute("INSERT INTO face_chips (record_id, session_id, slot, kps) VALUES (?, ?, ?, ?)",
+                 (record_id, session_id, slot, np.asarray(kps, dtype=np.float32).tobytes()))
+    if commit:
+        conn.commit()
+    return slot
+
+# Đọc ảnh khuôn mặt của một buổi thực tập, chỉ lấy các ô cần thiết từ file ánh xạ bộ nhớ
+def load_chips(session_id, record_ids=None, db_path=DB_PATH, chip_dir=CHIP_DIR):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT record_id, slot, kps FROM face_chips WHERE session_id = ? ORDER BY slot", (session_id,))
+    rows = c.fetchall()
+    conn.close()
+    if record_ids is not None:
+        wanted = set(record_ids)
+        rows = [row for row in rows if row[0] in wanted]
+    chip_file = get_chip_file(session_id, chip_dir)
+    if not rows or not os.path.exists(chip_file):
+        return [], np.empty((0,) + CHIP_SHAPE, dtype=np.uint8), np.empty((0, 5, 2), dtype=np.float32)
+    n_slots = os.path.getsize(chip_file) // CHIP_BYTES
+    chips = np.memmap(chip_file, dtype=np.uint8, mode='r', shape=(n_slots,) + CHIP_SHAPE)
+    rows = [row for row in rows if row[1] < n_slots]
+    slots = np.array([row[1] for row in rows], dtype=np.int64)
+    kps = np.stack([np.frombuffer(row[2], dtype=np.float32).reshape(5, 2) for row in rows]) if rows else np.empty((0, 5, 2), dtype=np.float32)
+    return [row[0] for row in rows], chips[slots], kps
+
+# Trích xuất embedding trực tiếp từ ảnh khuôn mặt đã căn chỉnh, bỏ qua bước phát hiện
+def embed_chips(recognizer, chips, batch_size=EMBED_BATCH_SIZE):
+    rec_model = recognizer.app.models['recognition']
+    embeddings = []
+    for start in range(0, len(chips), batch_size):
+        batch = [np.asarray(chip) for chip in chips[start:start + batch_size]]
+        embeddings.append(rec_model.get_feat(batch).astype(np.float32))
+    if not embeddings:
+        return np.empty((0, 512), dtype=np.float32)
+    return np.concatenate(embeddings)
+
+# Tạo ảnh khuôn mặt cho các bản ghi đã đăng ký trước khi có tính năng này
+def backfill_chips(recognizer, db_path=DB_PATH, chip_dir=CHIP_DIR, on_progress=None):
+    conn = sqlite3.connect(db_path)
+    init_chip_tables(conn, chip_dir)
+    c = conn.cursor()
+    c.execute("""
+        SELECT s.record_id, s.session_id, s.image_path FROM students s
+        LEFT JOIN face_chips f ON f.record_id = s.record_id
+        WHERE f.record_id IS NULL
+        ORDER BY s.session_id, s.record_id
+    """)
+    rows = c.fetchall()
+    saved = 0
+    skipped = 0
+    for i, (record_id, session_id, image_path) in enumerate(rows):
+        face = None
+        img_array = None
+        if image_path and os.path.exists(image_path):
+            img_array = np.array(Image.open(image_path))
+            face = recognizer.get_face(img_array)
+        if face is None:
+            skipped += 1
+        else:
+            save_chip(conn, record_id, session_id, extract_chip(img_array, face), face.kps, chip_dir)
+            saved += 1
+        if on_progress:
+            on_progress(i + 1, len(rows))
+    conn.close()
+    return saved, skipped
+
+# So sánh tốc độ trích xuất embedding từ ảnh gốc (có phát hiện) và từ ảnh khuôn mặt đã lưu
+def benchmark(recognizer, session_id, limit=200, db_path=DB_PATH, chip_dir=CHIP_DIR):
+    record_ids, chips, _ = load_chips(session_id, db_path=db_path, chip_dir=chip_dir)
+    record_ids = record_ids[:limit]
+    chips = chips[:limit]
+    if not record_ids:
+        return None
+    conn = sqlite3.connect(db_path)
+    placeholders = ','.join('?' * len(record_ids))
+    paths = dict(conn.execute(f"SELECT record_id, image_path FROM students WHERE record_id IN ({placeholders})", record_ids).fetchall())
+    conn.close()
+
+    start = time.perf_counter()
+    full_embeddings = {}
+    for record_id in record_ids:
+        image_path = paths.get(record_id)
+        if image_path and os.path.exists(image_path):
+            embedding = recognizer.get_embedding(np.array(Image.open(image_path)))
+            if embedding is not None:
+                full_embeddings[record_id] = embedding
+    full_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chip_embeddings = embed_chips(recognizer, chips)
+    chip_elapsed = time.perf_counter() - start
+
+    diffs = [np.linalg.norm(full_embeddings[r] - e) for r, e in zip(record_ids, chip_embeddings) if r in full_embeddings]
+    return {
+        'images': len(record_ids),
+        'full_detection_per_second': len(record_ids) / full_elapsed if full_elapsed > 0 else 0.0,
+        'chip_per_second': len(record_ids) / chip_elapsed if chip_elapsed > 0 else 0.0,
+        'max_embedding_difference': float(max(diffs)) if diffs else None,
+    }
+
+if __name__ == '__main__':
+    from recognizer import FaceRecognizer
+
+    parser = argparse.ArgumentParser(description="Quản lý ảnh khuôn mặt đã căn chỉnh của sinh viên")
+    parser.add_argument('command', choices=['backfill', 'bench'])
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--chip-dir', default=CHIP_DIR)
+    parser.add_argument('--session-id', type=int, help="Buổi thực tập dùng để đo tốc độ")
+    parser.add_argument('--limit', type=int, default=200)
+    args = parser.parse_args()
+
+    recognizer = FaceRecognizer()
+    if args.command == 'backfill':
+        saved, skipped = backfill_chips(recognizer, args.db, args.chip_dir,
+                                        on_progress=lambda done, total: print(f"\r{done}/{total}", end='', flush=True))
+        print(f"\nĐã lưu {saved} ảnh khuôn mặt, bỏ qua {skipped} bản ghi không có đúng một khuôn mặt.")
+    else:
+        if args.session_id is None:
+            parser.error("--session-id là bắt buộc với lệnh bench")
+        result = benchmark(recognizer, args.session_id, args.limit, args.db, args.chip_dir)
+        if result is None:
+            print("Buổi thực tập chưa có ảnh khuôn mặt nào. Hãy chạy 'backfill' trước.")
+        else:
+            print(f"Số ảnh: {result['images']}")
+            print(f"Phát hiện + nhận diện trên ảnh gốc: {result['full_detection_per_second']:.1f} ảnh/s")
+            print(f"Nhận diện trực tiếp từ ảnh khuôn mặt: {result['chip_per_second']:.1f} ảnh/s")
+            print(f"Chênh lệch embedding lớn nhất: {result['max_embedding_difference']}")
@@ -0,0 +1,294 @@
+import argparse
+import glob
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
+
+import numpy as np
+
+from attendance_flow import load_embeddings_by_session
+
+DB_PATH = 'attendance.db'
+CACHE_DIR = 'gallery_cache'
+EMBEDDING_DIM = 512
+
+# Phiên bản tập embedding của từng buổi thực tập, tăng bởi trigger mỗi khi bảng students thay đổi
+def init_gallery_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS gallery_versions
+                 (session_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)''')
+    bump = "INSERT INTO gallery_versions (session_id, version) VALUES ({0}.session_id, 1) ON CONFLICT(session_id) DO UPDATE SET version = version + 1;"
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS gallery_version_insert AFTER INSERT ON students
+                 BEGIN {bump.format('NEW')} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS gallery_version_delete AFTER DELETE ON students
+                 BEGIN {bump.format('OLD')} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS gallery_version_update AFTER UPDATE OF id, name, embedding, session_id ON students
+                 BEGIN {bump.format('OLD')} {bump.format('NEW')} END''')
+    conn.commit()
+
+def get_gallery_version(conn, session_id):
+    row = conn.execute("SELECT version FROM gallery_versions WHERE session_id = ?", (session_id,)).fetchone()
+    return row[0] if row else 0
+
+def _snapshot_prefix(session_id, version, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"session_{session_id}_v{version}")
+
+def _load_array(path):
+    # Không thể ánh xạ bộ nhớ một mảng rỗng
+    array = np.load(path, mmap_mode='r')
+    return array if array.size else np.load(path)
+
+# Ảnh chụp chỉ đọc của tập embedding một buổi thực tập ở một phiên bản:
+# ma trận embedding float32 liên tục và mảng thông tin (record_id, MSSV, tên) độ rộng cố định,
+# cả hai được ánh xạ bộ nhớ từ file nên mọi luồng và tiến trình mở cùng file dùng chung một bản trong RAM
+class GallerySnapshot:
+    def __init__(self, session_id, version, prefix):
+        self.session_id = session_id
+        self.version = version
+        self.prefix = prefix
+        self.embeddings = _load_array(prefix + '.emb.npy')
+        metadata = _load_array(prefix + '.meta.npy')
+        self.record_ids = metadata['record_id']
+        self.ids = metadata['id']
+        self.names = metadata['name']
+
+    # Mở lại ảnh chụp trong một tiến trình khác từ đường dẫn
+    @classmethod
+    def open(cls, prefix):
+        session_id, version = os.path.basename(prefix)[len('session_'):].split('_v')
+        return cls(int(session_id), int(version), prefix)
+
+    @property
+    def key(self):
+        return self.session_id, self.version
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    # Cùng định dạng với load_embeddings_by_session để truyền cho process_attendance_frame
+    def as_gallery(self):
+        return self.record_ids, self.ids, self.names, self.embeddings
+
+    def nbytes(self):
+        return os.path.getsize(self.prefix + '.emb.npy') + os.path.getsize(self.prefix + '.meta.npy')
+
+# Ghi ảnh chụp của buổi thực tập; phiên bản và dữ liệu được đọc trong cùng một transaction
+def build_snapshot(session_id, db_path=DB_PATH, cache_dir=CACHE_DIR):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        version = get_gallery_version(conn, session_id)
+        rows = conn.execute("SELECT record_id, id, name, embedding FROM students WHERE session_id = ? ORDER BY record_id",
+                            (session_id,)).fetchall()
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    prefix = _snapshot_prefix(session_id, version, cache_dir)
+    if os.path.exists(prefix + '.emb.npy') and os.path.exists(prefix + '.meta.npy'):
+        return version, prefix
+    embeddings = np.empty((len(rows), EMBEDDING_DIM), dtype=np.float32)
+    for i, row in enumerate(rows):
+        embeddings[i] = np.frombuffer(row[3], dtype=np.float32)
+    ids = ['' if row[1] is None else str(row[1]) for row in rows]
+    names = ['' if row[2] is None else str(row[2]) for row in rows]
+    metadata = np.empty(len(rows), dtype=[('record_id', np.int64),
+                                          ('id', f"U{max([1] + [len(s) for s in ids])}"),
+                                          ('name', f"U{max([1] + [len(s) for s in names])}")])
+    metadata['record_id'] = [row[0] for row in rows]
+    metadata['id'] = ids
+    metadata['name'] = names
+    os.makedirs(cache_dir, exist_ok=True)
+    # Ghi ra file tạm rồi đổi tên để tiến trình khác không bao giờ đọc phải file ghi dở
+    for suffix, array in [('.meta.npy', metadata), ('.emb.npy', embeddings)]:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, prefix + suffix)
+    return version, prefix
+
+# Mỗi tiến trình đang ánh xạ một ảnh chụp giữ một file lease rỗng <prefix>.<pid>.lease;
+# file ảnh chụp chỉ bị xóa khi không còn tiến trình nào đang chạy giữ lease
+def _lease_path(prefix, pid=None):
+    return f"{prefix}.{os.getpid() if pid is None else pid}.lease"
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # os.kill(pid, 0) kết thúc tiến trình trên Windows; coi như tiến trình vẫn chạy
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _lease_pid(path):
+    try:
+        return int(path.rsplit('.', 2)[1])
+    except (IndexError, ValueError):
+        return None
+
+def _live_leases(prefix):
+    return [pid for pid in map(_lease_pid, glob.glob(glob.escape(prefix) + '.*.lease')) if pid is not None and _pid_alive(pid)]
+
+def _create_lease_file(prefix):
+    with open(_lease_path(prefix), 'a'):
+        pass
+
+def _remove_lease_file(prefix):
+    try:
+        os.remove(_lease_path(prefix))
+    except OSError:
+        pass
+
+def _remove_snapshot_files(prefix):
+    for suffix in ('.emb.npy', '.meta.npy'):
+        try:
+            os.remove(prefix + suffix)
+        except OSError:
+            # Trên Windows không xóa được file đang ánh xạ; file sẽ được dọn ở lần khởi động sau
+            pass
+
+# Quyền sử dụng một ảnh chụp; trả lại bằng release() hoặc tự động khi đối tượng bị thu hồi
+class GalleryLease:
+    def __init__(self, registry, snapshot):
+        self.snapshot = snapshot
+        self._finalizer = weakref.finalize(self, registry._release, snapshot.key)
+
+    def release(self):
+        self._finalizer()
+
+# Danh sách ảnh chụp dùng chung, mỗi (buổi thực tập, phiên bản) có đúng một ảnh chụp.
+# Ảnh chụp của phiên bản cũ bị loại bỏ khi không còn ai sử dụng.
+class GalleryRegistry:
+    def __init__(self, db_path=DB_PATH, cache_dir=CACHE_DIR):
+        self.db_path = db_path
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._refcounts = {}
+        self._latest = {}
+        # File của lần chạy trước có thể ứng với một cơ sở dữ liệu khác: xóa lease của tiến trình đã dừng,
+        # rồi xóa các ảnh chụp không còn tiến trình nào giữ lease (tiến trình khác đang dùng thì giữ lại)
+        for path in glob.glob(os.path.join(glob.escape(cache_dir), 'session_*.lease')):
+            pid = _lease_pid(path)
+            if pid is not None and not _pid_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        prefixes = {path[:-len('.emb.npy')] if path.endswith('.emb.npy') else path[:-len('.meta.npy')]
+                    for path in glob.glob(os.path.join(glob.escape(cache_dir), 'session_*.npy'))}
+        for prefix in prefixes:
+            if not _live_leases(prefix):
+                _remove_snapshot_files(prefix)
+
+    def acquire(self, session_id):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            version = get_gallery_version(conn, session_id)
+        finally:
+            conn.close()
+        with self._lock:
+            snapshot = self._snapshots.get((session_id, version))
+            if snapshot is None:
+                snapshot = self._open_snapshot(session_id)
+                self._snapshots[snapshot.key] = snapshot
+            self._refcounts[snapshot.key] = self._refcounts.get(snapshot.key, 0) + 1
+            if snapshot.version > self._latest.get(session_id, -1):
+                self._latest[session_id] = snapshot.version
+                self._evict_stale(session_id)
+            return GalleryLease(self, snapshot)
+
+    # Gọi khi đang giữ khóa. Lease được ghi trước khi mở file; nếu tiến trình khác xóa file
+    # ngay trước đó (trước khi thấy lease) thì ghi lại ảnh chụp một lần nữa
+    def _open_snapshot(self, session_id):
+        for attempt in range(2):
+            version, prefix = build_snapshot(session_id, self.db_path, self.cache_dir)
+            snapshot = self._snapshots.get((session_id, version))
+            if snapshot is not None:
+                return snapshot
+            _create_lease_file(prefix)
+            try:
+                return GallerySnapshot(session_id, version, prefix)
+            except FileNotFoundError:
+                _remove_lease_file(prefix)
+                if attempt:
+                    raise
+
+    def _release(self, key):
+        with self._lock:
+            self._refcounts[key] -= 1
+            self._evict_stale(key[0])
+
+    # Gọi khi đang giữ khóa
+    def _evict_stale(self, session_id):
+        latest = self._latest.get(session_id)
+        for key in [key for key in self._snapshots if key[0] == session_id and key[1] != latest]:
+            if self._refcounts.get(key, 0) == 0:
+                snapshot = self._snapshots.pop(key)
+                self._refcounts.pop(key, None)
+                _remove_lease_file(snapshot.prefix)
+                if not _live_leases(snapshot.prefix):
+                    _remove_snapshot_files(snapshot.prefix)
+
+    def stats(self):
+        with self._lock:
+            return {'snapshots': len(self._snapshots),
+                    'leases': sum(self._refcounts.values()),
+                    'bytes': sum(snapshot.nbytes() for snapshot in self._snapshots.values())}
+
+# Đo bộ nhớ Python (tracemalloc) khi n_sessions phiên cùng mở trang điểm danh của một buổi:
+# mỗi phiên tự tải danh sách embedding so với dùng chung một ảnh chụp
+def benchmark(n_sessions=10, n_students=500):
+    from loadtest import create_synthetic_db
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'gallery.db')
+        create_synthetic_db(db_path, n_students)
+        conn = sqlite3.connect(db_path)
+        init_gallery_tables(conn)
+        conn.close()
+
+        def measure(load):
+            results = [None] * n_sessions
+            tracemalloc.start()
+            start = time.perf_counter()
+            threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, load())) for i in range(n_sessions)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return results, current, peak, elapsed
+
+        private, private_bytes, private_peak, private_elapsed = measure(lambda: load_embeddings_by_session(1, db_path))
+        del private
+        registry = GalleryRegistry(db_path, os.path.join(tmp_dir, CACHE_DIR))
+        leases, shared_bytes, shared_peak, shared_elapsed = measure(lambda: registry.acquire(1))
+        stats = registry.stats()
+        for lease in leases:
+            lease.release()
+    return {'sessions': n_sessions, 'students': n_students,
+            'private_bytes': private_bytes, 'private_peak': private_peak, 'private_seconds': private_elapsed,
+            'shared_bytes': shared_bytes, 'shared_peak': shared_peak, 'shared_seconds': shared_elapsed,
+            'snapshot_file_bytes': stats['bytes'], 'snapshots': stats['snapshots']}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đo bộ nhớ tiết kiệm được khi dùng chung ảnh chụp tập embedding")
+    parser.add_argument('--sessions', type=int, default=10, help="Số phiên trình duyệt đồng thời")
+    parser.add_argument('--students', type=int, nargs='+', default=[100, 500, 2000])
+    args = parser.parse_args()
+    print(f"{'Sinh viên':>9} {'Riêng (MB)':>11} {'Dùng chung (MB)':>16} {'File ánh xạ (MB)':>17} {'Tiết kiệm':>10}")
+    for n_students in args.students:
+        result = benchmark(args.sessions, n_students)
+        shared_total = result['shared_bytes'] + result['snapshot_file_bytes']
+        print(f"{n_students:>9} {result['private_bytes'] / 2**20:>11.2f} {result['shared_bytes'] / 2**20:>16.2f} "
+              f"{result['snapshot_file_bytes'] / 2**20:>17.2f} {1 - shared_total / result['private_bytes']:>10.0%}")
@@ -0,0 +1,226 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from attendance_flow import load_embeddings_by_session, process_attendance_frame
+from calibrate import DEFAULT_MATCH_CONFIG
+
+EMBEDDING_DIM = 512
+FRAME_SHAPE = (480, 640, 3)
+STAGES = ['load', 'detect', 'match', 'check', 'lock_wait', 'mark', 'total']
+
+# Khuôn mặt giả lập có cùng thuộc tính embedding như kết quả của insightface
+class StubFace:
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+class _StubApp:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def get(self, image):
+        return self.owner.detect(image)
+
+# Bộ nhận diện giả lập: chỉ số sinh viên được mã hóa trong điểm ảnh đầu tiên của khung hình,
+# độ trễ mô phỏng thời gian chạy mô hình (sleep nhả GIL như onnxruntime, hoặc tiêu tốn CPU).
+# Generator của NumPy không an toàn khi dùng từ nhiều luồng, mỗi kiosk cần một bộ nhận diện giả lập riêng.
+class StubRecognizer:
+    def __init__(self, embeddings, latency_ms=60.0, jitter_ms=10.0, burn_cpu=False, seed=0):
+        self.embeddings = embeddings
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.burn_cpu = burn_cpu
+        self.rng = np.random.default_rng(seed)
+        self.app = _StubApp(self)
+
+    def detect(self, image):
+        delay = max(0.0, self.latency_ms + self.jitter_ms * self.rng.standard_normal()) / 1000
+        if self.burn_cpu:
+            deadline = time.perf_counter() + delay
+            while time.perf_counter() < deadline:
+                pass
+        else:
+            time.sleep(delay)
+        index = int.from_bytes(image[0, 0, :3].tobytes(), 'big') - 1
+        if index < 0 or index >= len(self.embeddings):
+            return []
+        noise = self.rng.normal(scale=0.05, size=EMBEDDING_DIM).astype(np.float32)
+        return [StubFace(self.embeddings[index] + noise * np.linalg.norm(self.embeddings[index]) / np.sqrt(EMBEDDING_DIM))]
+
+# Khung hình giả lập cho sinh viên thứ index (None: khung hình không có khuôn mặt)
+def make_frame(index):
+    frame = np.zeros(FRAME_SHAPE, dtype=np.uint8)
+    if index is not None:
+        frame[0, 0, :3] = np.frombuffer((index + 1).to_bytes(3, 'big'), dtype=np.uint8)
+    return frame
+
+# Tạo cơ sở dữ liệu giả lập với một buổi thực tập và n_students sinh viên
+def create_synthetic_db(db_path, n_students, seed=0):
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS students
+                 (record_id INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT, name TEXT, embedding BLOB, image_path TEXT, session_id INTEGER, model_name TEXT, model_version TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (id INTEGER PRIMARY KEY, class_name TEXT, session_date TEXT, session_day TEXT, start_time TEXT, end_time TEXT, max_attendance_score INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS attendance
+                 (session_id INTEGER, student_id TEXT, status TEXT, timestamp TEXT, attendance_score INTEGER, note TEXT)''')
+    conn.execute("INSERT INTO sessions VALUES (1, 'RHM', '2025-01-06', 'Thứ Hai', '00:00', '23:59', 10)")
+    # Embedding giả lập có độ lớn tương tự embedding thật của insightface (~20-25)
+    embeddings = rng.normal(size=(n_students, EMBEDDING_DIM)).astype(np.float32)
+    conn.executemany("INSERT INTO students (id, name, embedding, image_path, session_id) VALUES (?, ?, ?, ?, 1)",
+                     [(f"SV{i:05d}", f"Sinh viên {i}", embeddings[i].tobytes(), None) for i in range(n_students)])
+    conn.commit()
+    conn.close()
+    return embeddings
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+# RSS hiện tại (MB), đọc từ /proc trên Linux, nếu không được thì dùng RSS lớn nhất
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Một kiosk điểm danh: phát lại khung hình với tốc độ fps cho đến thời điểm stop_at
+def run_kiosk(recognizer, db_path, n_students, fps, no_face_rate, samples, lock, stop_at, seed):
+    rng = np.random.default_rng(seed)
+    interval = 1.0 / fps
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    session_info = conn.execute("SELECT * FROM sessions WHERE id = 1").fetchone()
+    conn.close()
+    frames = 0
+    next_frame = time.perf_counter()
+    while time.perf_counter() < stop_at:
+        index = None if rng.random() < no_face_rate else int(rng.integers(0, n_students))
+        frame = make_frame(index)
+        timings = {}
+        start = time.perf_counter()
+        # Ứng dụng tải lại tập embedding ở mỗi lần chạy lại script (mỗi khung hình)
+        gallery = load_embeddings_by_session(1, db_path)
+        timings['load'] = time.perf_counter() - start
+        try:
+            process_attendance_frame(recognizer, frame, 1, session_info, gallery, DEFAULT_MATCH_CONFIG, db_path, timings)
+        except sqlite3.OperationalError:
+            timings['error'] = 1
+        timings['total'] = time.perf_counter() - start
+        with lock:
+            samples.append(timings)
+        frames += 1
+        next_frame += interval
+        delay = next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Kiosk bị chậm: bỏ qua các khung hình đã lỡ
+            next_frame = time.perf_counter()
+    return frames
+
+# Chạy n_kiosks kiosk đồng thời và tổng hợp độ trễ, thời gian chờ khóa, CPU và RSS.
+# Nếu có source_db, kiểm thử chạy trên một bản sao trong thư mục tạm, không bao giờ ghi vào cơ sở dữ liệu gốc.
+def run_load_test(n_kiosks, fps=2.0, duration=10.0, n_students=500, latency_ms=60.0, burn_cpu=False,
+                  no_face_rate=0.2, recognizer=None, source_db=None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'loadtest.db')
+        if source_db is None:
+            embeddings = create_synthetic_db(db_path, n_students)
+        else:
+            source = sqlite3.connect(source_db)
+            target = sqlite3.connect(db_path)
+            source.backup(target)
+            source.close()
+            target.close()
+            _, _, _, embeddings = load_embeddings_by_session(1, db_path)
+            embeddings = np.asarray(embeddings)
+            n_students = len(embeddings)
+        if recognizer is None:
+            recognizers = [StubRecognizer(embeddings, latency_ms=latency_ms, burn_cpu=burn_cpu, seed=k) for k in range(n_kiosks)]
+        else:
+            recognizers = [recognizer] * n_kiosks
+        samples = []
+        lock = threading.Lock()
+        frame_counts = [0] * n_kiosks
+        stop_at = time.perf_counter() + duration
+        cpu_start = _cpu_seconds()
+        wall_start = time.perf_counter()
+
+        def worker(k):
+            frame_counts[k] = run_kiosk(recognizers[k], db_path, n_students, fps, no_face_rate, samples, lock, stop_at, seed=k)
+
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(n_kiosks)]
+        peak_rss = _rss_mb()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            peak_rss = max(peak_rss, _rss_mb())
+            time.sleep(0.2)
+        wall = time.perf_counter() - wall_start
+        cpu = _cpu_seconds() - cpu_start
+
+    stats = {}
+    for stage in STAGES:
+        values = np.array([sample[stage] for sample in samples if stage in sample]) * 1000
+        if len(values):
+            stats[stage] = {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+                            'p99': float(np.percentile(values, 99)), 'count': len(values)}
+    return {
+        'kiosks': n_kiosks,
+        'target_fps': fps,
+        'achieved_fps': sum(frame_counts) / wall / n_kiosks,
+        'stages': stats,
+        'lock_waits_over_10ms': sum(1 for sample in samples if sample.get('lock_wait', 0) > 0.01),
+        'errors': sum(1 for sample in samples if 'error' in sample),
+        'cpu_cores': cpu / wall,
+        'peak_rss_mb': peak_rss,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Kiểm thử tải điểm danh với nhiều kiosk giả lập")
+    parser.add_argument('--kiosks', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--fps', type=float, default=2.0, help="Số khung hình mỗi giây của một kiosk")
+    parser.add_argument('--duration', type=float, default=10.0, help="Thời gian chạy mỗi mức tải (giây)")
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=60.0, help="Độ trễ của bộ nhận diện giả lập")
+    parser.add_argument('--burn-cpu', action='store_true', help="Bộ nhận diện giả lập tiêu tốn CPU thay vì sleep")
+    parser.add_argument('--latency-budget-ms', type=float, default=500.0, help="Độ trễ p95 tối đa chấp nhận được")
+    parser.add_argument('--real', action='store_true', help="Dùng mô hình insightface thật (khung hình không có khuôn mặt)")
+    parser.add_argument('--db', help="Dùng bản sao của cơ sở dữ liệu có sẵn (buổi thực tập 1) thay vì dữ liệu giả lập")
+    args = parser.parse_args()
+
+    recognizer = None
+    if args.real:
+        from recognizer import FaceRecognizer
+        recognizer = FaceRecognizer()
+
+    saturation = None
+    header = f"{'Kiosk':>5} {'fps/kiosk':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'khóa p95':>9} {'chờ>10ms':>9} {'lỗi':>5} {'CPU':>5} {'RSS MB':>7}"
+    print(header)
+    for n_kiosks in args.kiosks:
+        result = run_load_test(n_kiosks, args.fps, args.duration, args.students, args.latency_ms, args.burn_cpu,
+                               recognizer=recognizer, source_db=args.db)
+        total = result['stages'].get('total', {'p50': 0, 'p95': 0, 'p99': 0})
+        lock_p95 = result['stages'].get('lock_wait', {}).get('p95', 0.0)
+        print(f"{n_kiosks:>5} {result['achieved_fps']:>9.2f} {total['p50']:>9.1f} {total['p95']:>9.1f} {total['p99']:>9.1f} "
+              f"{lock_p95:>9.2f} {result['lock_waits_over_10ms']:>9} {result['errors']:>5} {result['cpu_cores']:>5.2f} {result['peak_rss_mb']:>7.0f}")
+        if saturation is None and (result['achieved_fps'] < 0.9 * args.fps or total['p95'] > args.latency_budget_ms):
+            saturation = n_kiosks
+    print("\nĐộ trễ theo từng bước ở mức tải cuối (p50 / p95 ms):")
+    for stage, values in result['stages'].items():
+        print(f"  {stage:>9}: {values['p50']:.2f} / {values['p95']:.2f}")
+    if saturation is None:
+        print(f"\nChưa bão hòa đến {args.kiosks[-1]} kiosk.")
+    else:
+        print(f"\nBão hòa từ {saturation} kiosk (fps < 90% mục tiêu hoặc p95 > {args.latency_budget_ms:.0f} ms).")
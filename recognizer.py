@@ -0,0 +1,36 @@
+import insightface
+
+# Thông tin mô hình dùng để trích xuất embedding
+MODEL_NAME = 'buffalo_l'
+DET_SIZE = (640, 640)
+
+# Chuỗi phiên bản mô hình được lưu kèm theo mỗi embedding
+def get_model_version(model_name=MODEL_NAME, det_size=DET_SIZE):
+    return f"insightface-{insightface.__version__}/{model_name}/det{det_size[0]}x{det_size[1]}"
+
+# Embedding tạo trước khi có cột model_version: phiên bản gốc dùng FaceAnalysis() và prepare(ctx_id=0),
+# với insightface 0.7.3 (phiên bản được cố định trong requirements.txt) là buffalo_l, det_size=(640, 640)
+LEGACY_MODEL_NAME = MODEL_NAME
+LEGACY_MODEL_VERSION = f"insightface-0.7.3/{LEGACY_MODEL_NAME}/det{DET_SIZE[0]}x{DET_SIZE[1]}"
+
+# Lớp nhận diện khuôn mặt
+class FaceRecognizer:
+    def __init__(self, model_name=MODEL_NAME, det_size=DET_SIZE):
+        self.model_name = model_name
+        self.det_size = det_size
+        self.model_version = get_model_version(model_name, det_size)
+        self.app = insightface.app.FaceAnalysis(name=model_name)
+        self.app.prepare(ctx_id=0, det_size=det_size)  # Sử dụng CPU
+
+    # Trả về khuôn mặt (kèm embedding và điểm mốc) nếu ảnh chứa đúng một khuôn mặt
+    def get_face(self, image):
+        faces = self.app.get(image)
+        if len(faces) == 1:
+            return faces[0]
+        return None
+
+    def get_embedding(self, image):
+        face = self.get_face(image)
+        if face is not None:
+            return face.embedding
+        return None
@@ -0,0 +1,230 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from face_chips import load_chips, embed_chips
+
+DB_PATH = 'attendance.db'
+BATCH_SIZE = 32
+NUM_WORKERS = 4
+
+# Bảng lưu tạm embedding mới, đồng thời là điểm checkpoint để tiếp tục sau khi bị gián đoạn
+def init_reembed_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS reembed_staging
+                 (record_id INTEGER PRIMARY KEY, session_id INTEGER, embedding BLOB, model_name TEXT, model_version TEXT, status TEXT)''')
+    conn.commit()
+
+# Đếm số bản ghi có embedding chưa thuộc phiên bản mô hình hiện tại
+def count_outdated_embeddings(model_version, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM students WHERE model_version IS NULL OR model_version != ?", (model_version,))
+    result = c.fetchone()
+    conn.close()
+    return result[0]
+
+# Bản ghi không tính lại được embedding (thiếu ảnh, không phát hiện khuôn mặt), đang chặn việc chuyển đổi buổi thực tập
+def get_failed_reembed_records(model_version, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("""
+        SELECT s.record_id, s.session_id, s.id, s.name, s.image_path FROM reembed_staging r
+        JOIN students s ON s.record_id = r.record_id
+        WHERE r.model_version = ? AND r.status = 'failed'
+        ORDER BY s.session_id, s.record_id
+    """, (model_version,))
+    result = c.fetchall()
+    conn.close()
+    return result
+
+# Xóa hẳn các bản ghi không tính lại được (người vận hành xác nhận); sinh viên cần đăng ký lại ảnh
+def drop_failed_records(record_ids, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    with conn:
+        for record_id in record_ids:
+            conn.execute("DELETE FROM students WHERE record_id = ?", (record_id,))
+            conn.execute("DELETE FROM face_chips WHERE record_id = ?", (record_id,))
+            conn.execute("DELETE FROM reembed_staging WHERE record_id = ?", (record_id,))
+    conn.close()
+
+# Tiến độ của tác vụ tính lại embedding
+class ReembedProgress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.sessions_migrated = 0
+        self.blocked_sessions = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+
+    def images_per_second(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    def eta_seconds(self):
+        rate = self.images_per_second()
+        if rate <= 0:
+            return None
+        return (self.total - self.done) / rate
+
+    def summary(self):
+        eta = self.eta_seconds()
+        eta_text = f"{eta:.0f}s" if eta is not None else "--"
+        return (f"{self.done}/{self.total} ảnh ({self.failed} lỗi) - {self.images_per_second():.1f} ảnh/s - "
+                f"còn lại ~{eta_text} - {self.sessions_migrated} buổi đã chuyển đổi"
+                + (f", {len(self.blocked_sessions)} buổi bị chặn do có bản ghi lỗi" if self.blocked_sessions else ""))
+
+# Tác vụ nền tính lại embedding của tất cả sinh viên khi đổi mô hình
+class ReembedJob:
+    def __init__(self, recognizer, db_path=DB_PATH, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, use_chips=False):
+        self.recognizer = recognizer
+        self.db_path = db_path
+        # Dùng ảnh khuôn mặt đã căn chỉnh (nếu có) để bỏ qua bước phát hiện
+        self.use_chips = use_chips
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.progress = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name='reembed-job', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self, on_batch=None):
+        model_name = self.recognizer.model_name
+        model_version = self.recognizer.model_version
+        conn = sqlite3.connect(self.db_path)
+        try:
+            init_reembed_tables(conn)
+            # Bỏ các kết quả tạm của lần chạy với mô hình khác; các bản ghi lỗi lần trước được thử lại
+            conn.execute("DELETE FROM reembed_staging WHERE model_version != ? OR status = 'failed'", (model_version,))
+            conn.commit()
+            c = conn.cursor()
+            c.execute("""
+                SELECT COUNT(*) FROM students
+                WHERE (model_version IS NULL OR model_version != ?)
+                AND record_id NOT IN (SELECT record_id FROM reembed_staging WHERE model_version = ?)
+            """, (model_version, model_version))
+            self.progress = ReembedProgress(c.fetchone()[0])
+            c.execute("SELECT DISTINCT session_id FROM students WHERE model_version IS NULL OR model_version != ? ORDER BY session_id",
+                      (model_version,))
+            session_ids = [row[0] for row in c.fetchall()]
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                for session_id in session_ids:
+                    if not self._migrate_session(conn, executor, session_id, model_name, model_version, on_batch):
+                        break
+        except Exception as e:
+            if self.progress is not None:
+                self.progress.error = str(e)
+            raise
+        finally:
+            conn.close()
+            if self.progress is not None:
+                self.progress.finished_at = time.time()
+
+    def _migrate_session(self, conn, executor, session_id, model_name, model_version, on_batch):
+        last_record_id = -1
+        while True:
+            if self._stop_event.is_set():
+                return False
+            c = conn.cursor()
+            c.execute("""
+                SELECT record_id, image_path FROM students
+                WHERE session_id = ? AND record_id > ?
+                AND (model_version IS NULL OR model_version != ?)
+                AND record_id NOT IN (SELECT record_id FROM reembed_staging WHERE model_version = ?)
+                ORDER BY record_id LIMIT ?
+            """, (session_id, last_record_id, model_version, model_version, self.batch_size))
+            rows = c.fetchall()
+            if not rows:
+                break
+            last_record_id = rows[-1][0]
+            embeddings = {}
+            if self.use_chips:
+                chip_ids, chips, _ = load_chips(session_id, [row[0] for row in rows], db_path=self.db_path)
+                embeddings.update(zip(chip_ids, embed_chips(self.recognizer, chips)))
+            missing = [row for row in rows if row[0] not in embeddings]
+            embeddings.update(zip([row[0] for row in missing], executor.map(self._embed_one, [row[1] for row in missing])))
+            staged = []
+            for record_id, _ in rows:
+                embedding = embeddings[record_id]
+                if embedding is None:
+                    staged.append((record_id, session_id, None, model_name, model_version, 'failed'))
+                    self.progress.failed += 1
+                else:
+                    staged.append((record_id, session_id, embedding.astype(np.float32).tobytes(), model_name, model_version, 'ok'))
+            # Ghi kết quả theo từng lô trong một transaction
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO reembed_staging (record_id, session_id, embedding, model_name, model_version, status) VALUES (?, ?, ?, ?, ?, ?)",
+                                 staged)
+            self.progress.done += len(rows)
+            if on_batch:
+                on_batch(self.progress)
+        # Buổi có bản ghi lỗi tiếp tục dùng embedding cũ cho đến khi bản ghi đó được xóa hoặc đăng ký lại;
+        # các embedding mới đã tính vẫn được giữ trong bảng tạm
+        failed = conn.execute("""
+            SELECT COUNT(*) FROM reembed_staging r JOIN students s ON s.record_id = r.record_id
+            WHERE s.session_id = ? AND r.model_version = ? AND r.status = 'failed'
+        """, (session_id, model_version)).fetchone()[0]
+        if failed:
+            self.progress.blocked_sessions.append(session_id)
+            return True
+        self._swap_session(conn, session_id, model_name, model_version)
+        self.progress.sessions_migrated += 1
+        return True
+
+    # Chỉ thay embedding của buổi thực tập khi toàn bộ bản ghi đã được tính lại thành công
+    def _swap_session(self, conn, session_id, model_name, model_version):
+        with conn:
+            conn.execute("""
+                UPDATE students
+                SET embedding = (SELECT r.embedding FROM reembed_staging r WHERE r.record_id = students.record_id),
+                    model_name = ?, model_version = ?
+                WHERE session_id = ? AND record_id IN
+                    (SELECT record_id FROM reembed_staging WHERE session_id = ? AND model_version = ? AND status = 'ok')
+            """, (model_name, model_version, session_id, session_id, model_version))
+            conn.execute("DELETE FROM reembed_staging WHERE session_id = ? AND status = 'ok'", (session_id,))
+
+    def _embed_one(self, image_path):
+        if not image_path or not os.path.exists(image_path):
+            return None
+        try:
+            image = Image.open(image_path).convert('RGB')
+        except OSError:
+            return None
+        return self.recognizer.get_embedding(np.array(image))
+
+if __name__ == '__main__':
+    from recognizer import FaceRecognizer
+
+    parser = argparse.ArgumentParser(description="Tính lại embedding của sinh viên theo mô hình hiện tại")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--use-chips', action='store_true', help="Dùng ảnh khuôn mặt đã lưu thay vì phát hiện lại trên ảnh gốc")
+    args = parser.parse_args()
+
+    job = ReembedJob(FaceRecognizer(), db_path=args.db, batch_size=args.batch_size, num_workers=args.workers, use_chips=args.use_chips)
+    job.run(on_batch=lambda progress: print(progress.summary(), flush=True))
+    if job.progress is not None:
+        print("Hoàn tất:", job.progress.summary())
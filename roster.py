@@ -0,0 +1,170 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+DB_PATH = 'attendance.db'
+MSSV_COLUMN = 'MSSV'
+NAME_COLUMN = 'Họ tên SV'
+
+# Bảng danh sách sinh viên (roster) và lịch sử các file Excel đã nhập
+def init_roster_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS roster
+                 (mssv TEXT PRIMARY KEY, name TEXT, updated_at TEXT)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_roster_name ON roster (name)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS roster_imports
+                 (content_hash TEXT PRIMARY KEY, file_name TEXT, row_count INTEGER, imported_at TEXT, errors TEXT)''')
+    # Bổ sung cột lưu lỗi kiểm tra (JSON) cho cơ sở dữ liệu cũ
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(roster_imports)").fetchall()]
+    if 'errors' not in columns:
+        conn.execute("ALTER TABLE roster_imports ADD COLUMN errors TEXT")
+    conn.execute('''CREATE TABLE IF NOT EXISTS roster_import_rows
+                 (content_hash TEXT, mssv TEXT, PRIMARY KEY (content_hash, mssv))''')
+    conn.commit()
+
+# Mã băm nội dung file, dùng làm khóa để không phải đọc lại cùng một file
+def get_content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+# Chuẩn hóa MSSV (Excel có thể lưu MSSV dạng số, ví dụ 2153010001.0)
+def normalize_mssv(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    text = str(value).strip()
+    if text.endswith('.0') and text[:-2].isdigit():
+        text = text[:-2]
+    return text
+
+# Đọc và kiểm tra file Excel, trả về danh sách (MSSV, họ tên) hợp lệ và các lỗi
+def parse_roster(data):
+    df = pd.read_excel(BytesIO(data), dtype={MSSV_COLUMN: str})
+    missing = [column for column in (MSSV_COLUMN, NAME_COLUMN) if column not in df.columns]
+    if missing:
+        raise ValueError(f"File Excel thiếu cột: {', '.join(missing)}")
+    rows = {}
+    errors = []
+    for line, (mssv, name) in enumerate(zip(df[MSSV_COLUMN], df[NAME_COLUMN]), start=2):
+        mssv = normalize_mssv(mssv)
+        name = '' if pd.isna(name) else str(name).strip()
+        if not mssv and not name:
+            continue
+        if not mssv:
+            errors.append(f"Dòng {line}: thiếu MSSV cho sinh viên '{name}'")
+        elif not name:
+            errors.append(f"Dòng {line}: thiếu họ tên cho MSSV {mssv}")
+        elif mssv in rows and rows[mssv].lower() != name.lower():
+            errors.append(f"Dòng {line}: MSSV {mssv} bị trùng với tên khác ('{rows[mssv]}' và '{name}')")
+        else:
+            rows[mssv] = name
+    return list(rows.items()), errors
+
+# Nhập danh sách sinh viên vào bảng roster; file đã nhập trước đó sẽ không được đọc lại
+def import_roster(data, file_name, db_path=DB_PATH):
+    start = time.perf_counter()
+    content_hash = get_content_hash(data)
+    conn = sqlite3.connect(db_path)
+    init_roster_tables(conn)
+    c = conn.cursor()
+    c.execute("SELECT row_count, errors FROM roster_imports WHERE content_hash = ?", (content_hash,))
+    existing = c.fetchone()
+    if existing and existing[1] is None:
+        # Nhập trước khi có cột errors: kiểm tra lại file một lần để lưu lỗi
+        _, errors = parse_roster(data)
+        with conn:
+            conn.execute("UPDATE roster_imports SET errors = ? WHERE content_hash = ?",
+                         (json.dumps(errors, ensure_ascii=False), content_hash))
+        existing = (existing[0], json.dumps(errors, ensure_ascii=False))
+    if existing:
+        conn.close()
+        # Lỗi kiểm tra được lưu lại để vẫn hiển thị khi dùng lại kết quả nhập trước đó
+        return {'content_hash': content_hash, 'cached': True, 'row_count': existing[0], 'errors': json.loads(existing[1] or '[]'),
+                'elapsed': time.perf_counter() - start}
+    rows, errors = parse_roster(data)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with conn:
+        conn.executemany("""
+            INSERT INTO roster (mssv, name, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(mssv) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at
+        """, [(mssv, name, now) for mssv, name in rows])
+        conn.executemany("INSERT OR IGNORE INTO roster_import_rows (content_hash, mssv) VALUES (?, ?)",
+                         [(content_hash, mssv) for mssv, _ in rows])
+        conn.execute("INSERT INTO roster_imports (content_hash, file_name, row_count, imported_at, errors) VALUES (?, ?, ?, ?, ?)",
+                     (content_hash, file_name, len(rows), now, json.dumps(errors, ensure_ascii=False)))
+    conn.close()
+    return {'content_hash': content_hash, 'cached': False, 'row_count': len(rows), 'errors': errors,
+            'elapsed': time.perf_counter() - start}
+
+# Lấy danh sách sinh viên của một file Excel đã nhập
+def get_roster_students(content_hash, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("""
+        SELECT r.mssv, r.name FROM roster_import_rows i
+        JOIN roster r ON r.mssv = i.mssv
+        WHERE i.content_hash = ?
+        ORDER BY r.name
+    """, (content_hash,))
+    students = c.fetchall()
+    conn.close()
+    return students
+
+# Tra cứu họ tên theo MSSV trong bảng roster
+def get_roster_name(mssv, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT name FROM roster WHERE mssv = ?", (mssv,))
+    result = c.fetchone()
+    conn.close()
+    if result:
+        return result[0]
+    else:
+        return None
+
+# Đo thời gian nhập các danh sách có kích thước khác nhau
+def benchmark(sizes=(500, 1000, 2000, 5000)):
+    results = []
+    for size in sizes:
+        df = pd.DataFrame({
+            'STT': range(1, size + 1),
+            MSSV_COLUMN: [f"21530{i:05d}" for i in range(size)],
+            NAME_COLUMN: [f"Nguyễn Văn Sinh Viên {i}" for i in range(size)],
+        })
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False)
+        data = output.getvalue()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'roster_bench.db')
+            first = import_roster(data, f"bench_{size}.xlsx", db_path)
+            second = import_roster(data, f"bench_{size}.xlsx", db_path)
+        results.append((size, first['elapsed'], second['elapsed']))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Nhập danh sách sinh viên từ file Excel")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('file')
+    import_parser.add_argument('--db', default=DB_PATH)
+    bench_parser = subparsers.add_parser('bench')
+    bench_parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 5000])
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        with open(args.file, 'rb') as f:
+            result = import_roster(f.read(), os.path.basename(args.file), args.db)
+        status = "đã nhập trước đó" if result['cached'] else "đã nhập"
+        print(f"{result['row_count']} sinh viên ({status}) trong {result['elapsed'] * 1000:.1f} ms")
+        for error in result['errors']:
+            print(error)
+    else:
+        print(f"{'Số dòng':>8} {'Nhập lần đầu (ms)':>18} {'Nhập lại (ms)':>14}")
+        for size, first, second in benchmark(args.sizes):
+            print(f"{size:>8} {first * 1000:>18.1f} {second * 1000:>14.2f}")
@@ -0,0 +1,188 @@
+import argparse
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+LATE_MINUTES = 15
+
+# Quy tắc tính điểm chuyên cần, xét theo thứ tự, quy tắc đầu tiên thỏa mãn được áp dụng.
+# Mỗi cận là (mốc 'start'/'end', số phút lệch so với mốc, có bao gồm cận hay không); None là không giới hạn.
+# Điểm 'max' nghĩa là điểm chuyên cần tối đa của buổi thực tập.
+SCORING_RULES = [
+    (('start', 0, True), ('end', 0, True), 'max', ""),
+    (('end', 0, False), ('end', LATE_MINUTES, False), 0, ""),
+    (('end', LATE_MINUTES, True), None, 0, f"Trễ >{LATE_MINUTES}p"),
+]
+DEFAULT_SCORE = (0, "Điểm danh sau giờ kết thúc")
+
+# Thời điểm của một cận theo giờ bắt đầu/kết thúc của buổi thực tập, cùng định dạng với timestamp điểm danh
+def _bound_time(session, bound):
+    anchor, offset, _ = bound
+    anchor_time = session['start_time'] if anchor == 'start' else session['end_time']
+    value = datetime.strptime(f"{session['session_date']} {anchor_time}", "%Y-%m-%d %H:%M") + timedelta(minutes=offset)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+def _rule_score(session, score):
+    return session['max_attendance_score'] if score == 'max' else score
+
+# Quy tắc đầu tiên thỏa mãn cho một lần điểm danh; None nếu không có quy tắc nào (dùng DEFAULT_SCORE)
+def _match_rule(session, timestamp):
+    for rule in SCORING_RULES:
+        lower, upper, _, _ = rule
+        if lower is not None:
+            bound = _bound_time(session, lower)
+            if timestamp < bound or (timestamp == bound and not lower[2]):
+                continue
+        if upper is not None:
+            bound = _bound_time(session, upper)
+            if timestamp > bound or (timestamp == bound and not upper[2]):
+                continue
+        return rule
+    return None
+
+# Tính điểm chuyên cần và ghi chú cho một lần điểm danh
+def score_attendance(session, timestamp):
+    rule = _match_rule(session, timestamp)
+    if rule is None:
+        return DEFAULT_SCORE
+    return _rule_score(session, rule[2]), rule[3]
+
+# Lần điểm danh được tính là trễ khi khớp một quy tắc có ghi chú (cùng ghi chú được lưu vào bản ghi),
+# để bảng theo dõi luôn khớp với bộ quy tắc tính điểm
+def is_late(session, timestamp):
+    rule = _match_rule(session, timestamp)
+    return rule is not None and bool(rule[3])
+
+# Sinh biểu thức CASE của SQL từ cùng bộ quy tắc để tính lại điểm cho cả buổi trong một câu lệnh.
+# prefix đặt trước tên tham số để dùng hai bộ quy tắc (trước/sau khi sửa) trong cùng một câu lệnh.
+def build_scoring_sql(session, column='timestamp', prefix=''):
+    params = {}
+    conditions = []
+    for i, (lower, upper, score, note) in enumerate(SCORING_RULES):
+        parts = []
+        if lower is not None:
+            params[f'{prefix}lower_{i}'] = _bound_time(session, lower)
+            parts.append(f"{column} {'>=' if lower[2] else '>'} :{prefix}lower_{i}")
+        if upper is not None:
+            params[f'{prefix}upper_{i}'] = _bound_time(session, upper)
+            parts.append(f"{column} {'<=' if upper[2] else '<'} :{prefix}upper_{i}")
+        params[f'{prefix}score_{i}'] = _rule_score(session, score)
+        params[f'{prefix}note_{i}'] = note
+        conditions.append((' AND '.join(parts) or '1', i))
+    params[f'{prefix}default_score'], params[f'{prefix}default_note'] = DEFAULT_SCORE
+    score_case = ("CASE " + ' '.join(f"WHEN {cond} THEN :{prefix}score_{i}" for cond, i in conditions)
+                  + f" ELSE :{prefix}default_score END")
+    note_case = ("CASE " + ' '.join(f"WHEN {cond} THEN :{prefix}note_{i}" for cond, i in conditions)
+                 + f" ELSE :{prefix}default_note END")
+    return score_case, note_case, params
+
+def _load_session(conn, session_id):
+    row = conn.execute("SELECT session_date, start_time, end_time, max_attendance_score FROM sessions WHERE id = ?",
+                       (session_id,)).fetchone()
+    return {'session_date': row[0], 'start_time': row[1], 'end_time': row[2], 'max_attendance_score': row[3]}
+
+# Biểu thức tính điểm mới, và điều kiện "kết quả phụ thuộc vào phần được sửa": bộ quy tắc cho kết quả khác nhau
+# giữa thông tin cũ và mới của buổi. Các bản ghi còn lại chỉ thay đổi khi được tính theo cách cũ
+# (phiên bản trước so sánh giờ với múi giờ LMT +07:07 nên khung giờ bị lệch sớm 7 phút).
+def _rescore_sql(session, old_session):
+    score_case, note_case, params = build_scoring_sql(session, prefix='new_')
+    old_score_case, old_note_case, old_params = build_scoring_sql(old_session, prefix='old_')
+    params.update(old_params)
+    edit_changed = f"(({old_score_case}) IS NOT ({score_case}) OR ({old_note_case}) IS NOT ({note_case}))"
+    return score_case, note_case, edit_changed, params
+
+# Xem trước các bản ghi sẽ thay đổi nếu buổi thực tập có thông tin mới.
+# Cột cuối là 1 nếu bản ghi chỉ thay đổi do được tính theo cách cũ (không phụ thuộc vào phần được sửa).
+def preview_rescore(conn, session_id, session, old_session=None):
+    old_session = old_session or _load_session(conn, session_id)
+    score_case, note_case, edit_changed, params = _rescore_sql(session, old_session)
+    params['session_id'] = session_id
+    return conn.execute(f"""
+        SELECT student_id, timestamp, attendance_score, note, new_score, new_note, NOT edit_changed FROM (
+            SELECT student_id, timestamp, attendance_score, note, {score_case} AS new_score, {note_case} AS new_note,
+                   {edit_changed} AS edit_changed
+            FROM attendance WHERE session_id = :session_id
+        ) WHERE attendance_score IS NOT new_score OR note IS NOT new_note
+        ORDER BY timestamp
+    """, params).fetchall()
+
+# Tính lại điểm của buổi bằng một câu lệnh UPDATE. Nếu có old_session và include_corrections=False,
+# chỉ các bản ghi có kết quả phụ thuộc vào phần được sửa mới được tính lại.
+def rescore_session(conn, session_id, session, old_session=None, include_corrections=True):
+    if old_session is None:
+        score_case, note_case, params = build_scoring_sql(session)
+        edit_changed = '1'
+    else:
+        score_case, note_case, edit_changed, params = _rescore_sql(session, old_session)
+    if include_corrections:
+        edit_changed = '1'
+    params['session_id'] = session_id
+    cursor = conn.execute(f"""
+        UPDATE attendance SET attendance_score = {score_case}, note = {note_case}
+        WHERE session_id = :session_id AND (attendance_score IS NOT {score_case} OR note IS NOT {note_case})
+        AND {edit_changed}
+    """, params)
+    return cursor.rowcount
+
+# Cập nhật giờ/điểm tối đa của buổi thực tập và tính lại điểm trong cùng một transaction.
+# Mặc định chỉ tính lại các bản ghi phụ thuộc vào phần được sửa; include_corrections=True sửa cả các bản ghi
+# được tính theo cách cũ.
+def update_session_and_rescore(conn, session_id, start_time, end_time, max_attendance_score, include_corrections=False):
+    old_session = _load_session(conn, session_id)
+    session = dict(old_session, start_time=start_time, end_time=end_time, max_attendance_score=max_attendance_score)
+    with conn:
+        conn.execute("UPDATE sessions SET start_time = ?, end_time = ?, max_attendance_score = ? WHERE id = ?",
+                     (start_time, end_time, max_attendance_score, session_id))
+        return rescore_session(conn, session_id, session, old_session, include_corrections)
+
+# So sánh tính lại điểm bằng SQL với cập nhật từng dòng trên một buổi có nhiều bản ghi điểm danh
+def benchmark(n_rows=5000):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE sessions
+                 (id INTEGER PRIMARY KEY, class_name TEXT, session_date TEXT, session_day TEXT, start_time TEXT, end_time TEXT, max_attendance_score INTEGER)''')
+    conn.execute('''CREATE TABLE attendance
+                 (session_id INTEGER, student_id TEXT, status TEXT, timestamp TEXT, attendance_score INTEGER, note TEXT)''')
+    conn.execute("INSERT INTO sessions VALUES (1, 'RHM', '2025-01-06', 'Thứ Hai', '07:00', '08:00', 10)")
+    base = datetime(2025, 1, 6, 6, 30)
+    session = dict(conn.execute("SELECT * FROM sessions WHERE id = 1").fetchone())
+    rows = []
+    for i in range(n_rows):
+        timestamp = (base + timedelta(seconds=i * 7200 // n_rows)).strftime(TIMESTAMP_FORMAT)
+        rows.append((1, f"SV{i}", 'present', timestamp) + score_attendance(session, timestamp))
+    conn.executemany("INSERT INTO attendance VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    new_session = dict(session, start_time='07:15', end_time='08:15')
+    start = time.perf_counter()
+    changed = len(preview_rescore(conn, 1, new_session, session))
+    preview_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with conn:
+        for row in conn.execute("SELECT rowid, timestamp FROM attendance WHERE session_id = 1").fetchall():
+            score, note = score_attendance(new_session, row['timestamp'])
+            conn.execute("UPDATE attendance SET attendance_score = ?, note = ? WHERE rowid = ?", (score, note, row['rowid']))
+    row_by_row_elapsed = time.perf_counter() - start
+
+    # Khôi phục dữ liệu ban đầu trước khi đo câu lệnh UPDATE
+    conn.execute("DELETE FROM attendance")
+    conn.executemany("INSERT INTO attendance VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    start = time.perf_counter()
+    update_session_and_rescore(conn, 1, '07:15', '08:15', 10)
+    sql_elapsed = time.perf_counter() - start
+    conn.close()
+    return {'rows': n_rows, 'changed': changed, 'preview_seconds': preview_elapsed,
+            'row_by_row_seconds': row_by_row_elapsed, 'sql_seconds': sql_elapsed}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đo thời gian tính lại điểm chuyên cần khi sửa giờ buổi thực tập")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 5000, 20000])
+    args = parser.parse_args()
+    print(f"{'Số dòng':>8} {'Thay đổi':>9} {'Xem trước (ms)':>15} {'Từng dòng (ms)':>15} {'UPDATE (ms)':>12}")
+    for n_rows in args.rows:
+        result = benchmark(n_rows)
+        print(f"{result['rows']:>8} {result['changed']:>9} {result['preview_seconds'] * 1000:>15.1f} "
+              f"{result['row_by_row_seconds'] * 1000:>15.1f} {result['sql_seconds'] * 1000:>12.1f}")
@@ -2,7 +2,6 @@ import streamlit as st
 import cv2
 import numpy as np
 import sqlite3
-import insightface
 from PIL import Image
 import time
 import gc
@@ -14,6 +13,18 @@ import pandas as pd
 from io import BytesIO
 from camera_input_live import camera_input_live
 import zipfile
+from recognizer import FaceRecognizer, LEGACY_MODEL_NAME, LEGACY_MODEL_VERSION
+from reembed import ReembedJob, init_reembed_tables, count_outdated_embeddings, get_failed_reembed_records, drop_failed_records
+from face_chips import init_chip_tables, extract_chip, save_chip
+from roster import init_roster_tables, import_roster, get_roster_students, get_roster_name
+from audit import init_audit_tables, run_audit
+from calibrate import load_match_config
+from attendance_flow import load_embeddings_by_session, process_attendance_frame, get_attendance_list
+from scoring import preview_rescore, update_session_and_rescore, is_late
+from events import event_bus, EVENT_LOG_PATH
+from archive import init_archive_tables, get_archived_sessions, get_archived_session_info, load_archived_attendance
+from gallery_cache import init_gallery_tables, GalleryRegistry
+from enrolment import BurstCollector, BURST_DEBOUNCE_MS, select_diverse_templates, compare_with_single_shot, save_burst_templates
 
 # Thiết lập múi giờ Việt Nam (UTC+7)
 tz = pytz.timezone('Asia/Ho_Chi_Minh')
@@ -28,7 +39,23 @@ def init_db():
                  (id INTEGER PRIMARY KEY, class_name TEXT, session_date TEXT, session_day TEXT, start_time TEXT, end_time TEXT, max_attendance_score INTEGER)''')
     c.execute('''CREATE TABLE IF NOT EXISTS attendance
                  (session_id INTEGER, student_id TEXT, status TEXT, timestamp TEXT, attendance_score INTEGER, note TEXT)''')
+    # Bổ sung cột lưu mô hình đã tạo embedding cho cơ sở dữ liệu cũ
+    c.execute("PRAGMA table_info(students)")
+    columns = [row[1] for row in c.fetchall()]
+    if 'model_name' not in columns:
+        c.execute("ALTER TABLE students ADD COLUMN model_name TEXT")
+    if 'model_version' not in columns:
+        c.execute("ALTER TABLE students ADD COLUMN model_version TEXT")
+    # Các bản ghi cũ được tạo bằng cấu hình mô hình mặc định, không cần tính lại embedding
+    c.execute("UPDATE students SET model_name = ?, model_version = ? WHERE model_version IS NULL",
+              (LEGACY_MODEL_NAME, LEGACY_MODEL_VERSION))
     conn.commit()
+    init_reembed_tables(conn)
+    init_chip_tables(conn)
+    init_roster_tables(conn)
+    init_archive_tables(conn)
+    init_audit_tables(conn)
+    init_gallery_tables(conn)
     conn.close()
 
 init_db()
@@ -121,6 +148,7 @@ def view_students_page():
     if st.button("Xóa Bản Ghi Này"):
         conn = get_db_connection()
         conn.execute("DELETE FROM students WHERE record_id = ?", (selected_record_id,))
+        conn.execute("DELETE FROM face_chips WHERE record_id = ?", (selected_record_id,))
         conn.commit()
         conn.close()
         st.success(f"Đã xóa bản ghi {selected_record_id}.")
@@ -155,17 +183,56 @@ def view_students_page():
             mime="application/zip"
             )
 
-# Lớp nhận diện khuôn mặt
-class FaceRecognizer:
-    def __init__(self):
-        self.app = insightface.app.FaceAnalysis()
-        self.app.prepare(ctx_id=0)  # Sử dụng CPU
-
-    def get_embedding(self, image):
-        faces = self.app.get(image)
-        if len(faces) == 1:
-            return faces[0].embedding
-        return None
+    # Tính lại embedding khi thay đổi mô hình nhận diện
+    with st.expander("Cập nhật embedding theo mô hình hiện tại"):
+        st.write(f"Mô hình hiện tại: {recognizer.model_version}")
+        job = get_reembed_job()
+        if job.is_running():
+            st.info(f"Đang tính lại embedding: {job.progress.summary() if job.progress else 'đang khởi động...'}")
+            if st.button("Làm mới tiến độ"):
+                st.rerun()
+            if st.button("Dừng tác vụ"):
+                job.stop()
+                st.rerun()
+        else:
+            if job.progress is not None:
+                if job.progress.error:
+                    st.error(f"Tác vụ bị lỗi: {job.progress.error}")
+                else:
+                    st.success(f"Lần chạy gần nhất: {job.progress.summary()}")
+            failed_records = get_failed_reembed_records(recognizer.model_version)
+            if failed_records:
+                st.error(f"Có {len(failed_records)} bản ghi không tính lại được embedding. Các buổi thực tập chứa chúng vẫn dùng mô hình cũ "
+                         "cho đến khi bản ghi được xóa (sau đó đăng ký lại ảnh) hoặc tính lại thành công.")
+                st.dataframe(pd.DataFrame(failed_records, columns=['Record ID', 'Buổi', 'MSSV', 'Tên', 'Ảnh']))
+                if st.button("Xóa các bản ghi lỗi"):
+                    drop_failed_records([row[0] for row in failed_records])
+                    st.rerun()
+            outdated = count_outdated_embeddings(recognizer.model_version)
+            if outdated:
+                st.warning(f"Có {outdated} bản ghi có embedding từ mô hình khác. Embedding cũ vẫn được dùng cho đến khi cả buổi được chuyển đổi xong.")
+                if st.button("Bắt đầu tính lại embedding (thử lại cả các bản ghi lỗi)" if failed_records else "Bắt đầu tính lại embedding"):
+                    job.start()
+                    st.rerun()
+            else:
+                st.write("Tất cả embedding đã thuộc mô hình hiện tại.")
+
+    # Kiểm tra cùng một khuôn mặt đăng ký dưới nhiều MSSV hoặc nhiều người dưới một MSSV
+    with st.expander("Kiểm tra khuôn mặt trùng lặp"):
+        incremental = st.checkbox("Chỉ kiểm tra các bản ghi mới kể từ lần kiểm tra trước", value=True)
+        if st.button("Chạy kiểm tra"):
+            report_path, n_duplicates, n_outliers, elapsed = run_audit(incremental=incremental)
+            st.write(f"Hoàn tất trong {elapsed:.1f}s: {n_duplicates} cặp trùng khuôn mặt khác MSSV, {n_outliers} bản ghi khác biệt với các ảnh cùng MSSV.")
+            if report_path:
+                report_df = pd.read_csv(report_path, encoding='utf-8-sig', dtype=str)
+                st.dataframe(report_df)
+                with open(report_path, "rb") as file:
+                    st.download_button(
+                        label="Tải về báo cáo (CSV)",
+                        data=file,
+                        file_name=os.path.basename(report_path),
+                        mime="text/csv"
+                    )
 
 # Cache mô hình để tránh tải lại
 @st.cache_resource
@@ -174,69 +241,45 @@ def get_recognizer():
 
 recognizer = get_recognizer()
 
-# Tải embedding của sinh viên theo session_id
-def load_embeddings_by_session(session_id):
-    conn = sqlite3.connect('attendance.db')
-    c = conn.cursor()
-    c.execute("SELECT record_id, id, name, embedding FROM students WHERE session_id = ?", (session_id,))
-    students = c.fetchall()
-    conn.close()
-    embeddings = []
-    record_ids = []
-    ids = []
-    names = []
-    for student in students:
-        record_ids.append(student[0])
-        ids.append(student[1])
-        names.append(student[2])
-        embeddings.append(np.frombuffer(student[3], dtype=np.float32))
-    return record_ids, ids, names, embeddings
-
-# Tìm sinh viên khớp nhất
-def find_closest_match(embedding, record_ids, ids, names, embeddings, threshold=20.0):
-    if not embeddings:
-        return None, None, None
-    student_embeddings = {}
-    for record_id, student_id, name, emb in zip(record_ids, ids, names, embeddings):
-        if student_id not in student_embeddings:
-            student_embeddings[student_id] = []
-        student_embeddings[student_id].append((record_id, emb))
-    
-    min_distances = {}
-    for student_id, emb_list in student_embeddings.items():
-        distances = [np.linalg.norm(embedding - emb[1]) for emb in emb_list]
-        min_distance = min(distances)
-        min_distances[student_id] = min_distance
-    
-    if min_distances:
-        closest_student_id = min(min_distances, key=min_distances.get)
-        min_distance = min_distances[closest_student_id]
-        if min_distance < threshold:
-            emb_list = student_embeddings[closest_student_id]
-            distances = [np.linalg.norm(embedding - emb[1]) for emb in emb_list]
-            index = distances.index(min_distance)
-            record_id = emb_list[index][0]
-            name = names[record_ids.index(record_id)]
-            return record_id, closest_student_id, name
-    return None, None, None
-
-# Kiểm tra xem sinh viên đã được điểm danh trong buổi thực tập chưa
-def check_attendance(session_id, student_id):
-    conn = sqlite3.connect('attendance.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM attendance WHERE session_id = ? AND student_id = ?", (session_id, student_id))
-    result = c.fetchone()
-    conn.close()
-    return result is not None
+# Ghi các sự kiện điểm danh ra file để công cụ khác theo dõi (tail -f)
+event_bus.set_sink(EVENT_LOG_PATH)
+
+# Điểm vận hành so khớp (độ đo và ngưỡng), hiệu chỉnh bằng calibrate.py
+match_config = load_match_config()
 
-# Ghi nhận điểm danh
-def mark_attendance(session_id, student_id, timestamp, attendance_score, note):
+# Tác vụ nền tính lại embedding, dùng chung cho mọi phiên làm việc
+@st.cache_resource
+def get_reembed_job():
+    return ReembedJob(recognizer)
+
+# Ảnh chụp tập embedding theo buổi thực tập, dùng chung cho mọi phiên làm việc
+@st.cache_resource
+def get_gallery_registry():
+    return GalleryRegistry()
+
+# Lưu ảnh gốc, embedding và ảnh khuôn mặt đã căn chỉnh của sinh viên
+def save_student_record(student_id, name, image, img_array, face, session_id):
+    if not os.path.exists('student_images'):
+        os.makedirs('student_images')
+    chip = extract_chip(img_array, face)
+    image_path = f"student_images/{student_id}_{name}_{datetime.now(tz).strftime('%Y%m%d%H%M%S')}.jpg"
+    image.save(image_path)
     conn = sqlite3.connect('attendance.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO attendance (session_id, student_id, status, timestamp, attendance_score, note) VALUES (?, ?, 'present', ?, ?, ?)",
-              (session_id, student_id, timestamp, attendance_score, note))
-    conn.commit()
-    conn.close()
+    try:
+        # Bản ghi và ảnh khuôn mặt được lưu trong cùng một transaction
+        with conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO students (id, name, embedding, image_path, session_id, model_name, model_version) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (student_id, name, face.embedding.tobytes(), image_path, session_id, recognizer.model_name, recognizer.model_version))
+            record_id = c.lastrowid
+            save_chip(conn, record_id, session_id, chip, face.kps, commit=False)
+    except Exception:
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        raise
+    finally:
+        conn.close()
+    return record_id
 
 # Tạo buổi thực tập
 def create_new_session(class_name, session_date, session_day, start_time, end_time, max_attendance_score):
@@ -247,9 +290,11 @@ def create_new_session(class_name, session_date, session_day, start_time, end_ti
     if existing_session:
         st.error(f"Khối thực tập '{class_name}' vào ngày '{session_date}' đã tồn tại.")
         return None
-    c.execute("INSERT INTO sessions (class_name, session_date, session_day, start_time, end_time, max_attendance_score) VALUES (?, ?, ?, ?, ?, ?)",
-              (class_name, session_date, session_day, start_time, end_time, max_attendance_score))
-    session_id = c.lastrowid
+    # Không dùng lại ID của các buổi đã được lưu trữ
+    c.execute("SELECT MAX(id) FROM (SELECT id FROM sessions UNION ALL SELECT id FROM archived_sessions)")
+    session_id = (c.fetchone()[0] or 0) + 1
+    c.execute("INSERT INTO sessions (id, class_name, session_date, session_day, start_time, end_time, max_attendance_score) VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (session_id, class_name, session_date, session_day, start_time, end_time, max_attendance_score))
     conn.commit()
     conn.close()
     return session_id
@@ -272,21 +317,6 @@ def get_session_info(session_id):
     conn.close()
     return session
 
-# Lấy danh sách sinh viên đã điểm danh trong buổi thực tập
-def get_attendance_list(session_id):
-    conn = sqlite3.connect('attendance.db')
-    c = conn.cursor()
-    c.execute("""
-        SELECT a.student_id, s.name, a.timestamp, a.attendance_score, a.note, ses.class_name, ses.session_date, ses.session_day, ses.start_time, ses.end_time
-        FROM attendance a
-        JOIN (SELECT id, MAX(name) as name FROM students GROUP BY id) s ON a.student_id = s.id
-        JOIN sessions ses ON a.session_id = ses.id
-        WHERE a.session_id = ? AND a.status = 'present'
-    """, (session_id,))
-    attendance_list = c.fetchall()
-    conn.close()
-    return attendance_list
-
 # Hàm chuyển đổi thứ sang tiếng Việt
 def get_vietnamese_day(day):
     days = {
@@ -538,13 +568,17 @@ if 'navigate_to' not in st.session_state:
     st.session_state['navigate_to'] = None
 
 # Sidebar navigation
-page = st.sidebar.radio("Chọn Chức năng", ["Đăng Ký Sinh Viên", "Tạo Buổi Thực Tập", "Điểm Danh", "Xem Sinh Viên", "Xem Điểm Danh"], key='page')
+page = st.sidebar.radio("Chọn Chức năng", ["Đăng Ký Sinh Viên", "Tạo Buổi Thực Tập", "Điểm Danh", "Theo Dõi Điểm Danh", "Xem Sinh Viên", "Xem Điểm Danh"], key='page')
 
 # Handle navigation from button click
 if st.session_state['navigate_to']:
     page = st.session_state['navigate_to']
     st.session_state['navigate_to'] = None  # Reset navigation
 
+# Trả lại ảnh chụp tập embedding khi rời trang Điểm Danh để phiên bản cũ có thể được dọn
+if page != "Điểm Danh" and st.session_state.get('gallery_lease') is not None:
+    st.session_state.pop('gallery_lease').release()
+
 if page == "Đăng Ký Sinh Viên":
     st.header("Đăng Ký Sinh Viên Mới")
     
@@ -557,10 +591,13 @@ if page == "Đăng Ký Sinh Viên":
         session_id = sessions[session_options.index(selected_session)]['id']
         
         # Thêm tùy chọn cho phương thức đăng ký ảnh
-        registration_method = st.radio("Chọn phương thức đăng ký ảnh", ["Chụp ảnh từ camera", "Tải lên ảnh từ máy tính"])
+        registration_method = st.radio("Chọn phương thức đăng ký ảnh", ["Chụp ảnh từ camera", "Chụp nhiều khung hình (camera trực tiếp)", "Tải lên ảnh từ máy tính"])
         
+        live_frame = None
         if registration_method == "Chụp ảnh từ camera":
             image_file = st.camera_input("Chụp ảnh sinh viên")
+        elif registration_method == "Chụp nhiều khung hình (camera trực tiếp)":
+            image_file = None
         else:
             image_file = st.file_uploader("Tải ảnh và nhập thông tin thủ công", type=["jpg", "png", "jpeg"])
             uploaded_files = st.file_uploader("Tải ảnh và đăng ký tự động (Định dạng file: ID_HoTen)", type=["jpg", "png", "jpeg"],
@@ -570,7 +607,14 @@ if page == "Đăng Ký Sinh Viên":
                     image = Image.open(uploaded_file)
                     st.image(image, caption=f"Ảnh: {uploaded_file.name}", use_container_width=True)
                     file_name = uploaded_file.name
-                    if '_' in file_name:
+                    # Ưu tiên họ tên trong danh sách sinh viên đã nhập (tra cứu theo MSSV)
+                    file_stem = os.path.splitext(file_name)[0]
+                    roster_name = get_roster_name(file_stem.split('_')[0])
+                    if roster_name:
+                        student_id = file_stem.split('_')[0]
+                        name = roster_name
+                        st.write(f"Tự động điền từ danh sách: MSSV = {student_id}, Tên = {name}")
+                    elif '_' in file_name:
                         parts = file_name.split('_')
                         if len(parts) >= 2:
                             student_id = parts[0]
@@ -589,19 +633,9 @@ if page == "Đăng Ký Sinh Viên":
                             st.error(f"MSSV {student_id} đã tồn tại với tên '{existing_name}'. Vui lòng nhập đúng tên.")
                         else:
                             img_array = np.array(image)
-                            embedding = recognizer.get_embedding(img_array)
-                            if embedding is not None:
-                                if not os.path.exists('student_images'):
-                                    os.makedirs('student_images')
-                                image_path = f"student_images/{student_id}_{name}_{datetime.now(tz).strftime('%Y%m%d%H%M%S')}.jpg"
-                                image.save(image_path)
-                                conn = sqlite3.connect('attendance.db')
-                                c = conn.cursor()
-                                c.execute(
-                                    "INSERT INTO students (id, name, embedding, image_path, session_id) VALUES (?, ?, ?, ?, ?)",
-                                    (student_id, name, embedding.tobytes(), image_path, session_id))
-                                conn.commit()
-                                conn.close()
+                            face = recognizer.get_face(img_array)
+                            if face is not None:
+                                save_student_record(student_id, name, image, img_array, face, session_id)
                                 st.success(
                                     f"Đã đăng ký hình ảnh cho sinh viên {name} với MSSV {student_id} thành công!")
                             else:
@@ -613,16 +647,32 @@ if page == "Đăng Ký Sinh Viên":
             if image_file is not None:
                 image = Image.open(image_file)
                 st.image(image, caption="Ảnh đã chọn", use_container_width=True)
+            elif registration_method == "Chụp nhiều khung hình (camera trực tiếp)":
+                # Mỗi khung hình mới làm script chạy lại; phát hiện khuôn mặt được thực hiện dần trên từng khung hình
+                live_frame = camera_input_live(debounce=BURST_DEBOUNCE_MS, key='burst_camera')
+                if st.button("Bắt đầu chụp nhiều khung hình"):
+                    st.session_state['burst_enrolment'] = BurstCollector()
         with col2:
             excel_file = st.file_uploader("Upload file Excel danh sách sinh viên", type=["xlsx", "xls"])
+            roster_students = []
             if excel_file is not None:
-                df = pd.read_excel(excel_file)
+                # Chỉ đọc file Excel một lần, các lần chạy lại dùng dữ liệu trong bảng roster
+                try:
+                    roster_import = import_roster(excel_file.getvalue(), excel_file.name)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    if not roster_import['cached']:
+                        st.success(f"Đã nhập {roster_import['row_count']} sinh viên trong {roster_import['elapsed'] * 1000:.0f} ms.")
+                    for error in roster_import['errors']:
+                        st.warning(error)
+                    roster_students = get_roster_students(roster_import['content_hash'])
+            if roster_students:
                 st.write("Danh sách sinh viên từ file Excel:")
-                st.dataframe(df)
-                student_options = df['Họ tên SV'].tolist()
-                selected_student = st.selectbox("Chọn sinh viên để đăng ký", student_options)
-                student_id = str(df[df['Họ tên SV'] == selected_student]['MSSV'].values[0])
-                name = selected_student
+                st.dataframe(pd.DataFrame(roster_students, columns=['MSSV', 'Họ tên SV']))
+                selected_index = st.selectbox("Chọn sinh viên để đăng ký", range(len(roster_students)),
+                                              format_func=lambda i: f"{roster_students[i][0]} - {roster_students[i][1]}")
+                student_id, name = roster_students[selected_index]
             else:
                 name = st.text_input("Tên Sinh Viên")
                 student_id = st.text_input("MSSV")
@@ -634,22 +684,51 @@ if page == "Đăng Ký Sinh Viên":
                 else:
                     image = Image.open(image_file)
                     img_array = np.array(image)
-                    embedding = recognizer.get_embedding(img_array)
-                    if embedding is not None:
-                        if not os.path.exists('student_images'):
-                            os.makedirs('student_images')
-                        image_path = f"student_images/{student_id}_{name}_{datetime.now(tz).strftime('%Y%m%d%H%M%S')}.jpg"
-                        image.save(image_path)
-                        conn = sqlite3.connect('attendance.db')
-                        c = conn.cursor()
-                        c.execute("INSERT INTO students (id, name, embedding, image_path, session_id) VALUES (?, ?, ?, ?, ?)",
-                                  (student_id, name, embedding.tobytes(), image_path, session_id))
-                        conn.commit()
-                        conn.close()
+                    face = recognizer.get_face(img_array)
+                    if face is not None:
+                        save_student_record(student_id, name, image, img_array, face, session_id)
                         st.success(f"Đã đăng ký hình ảnh cho sinh viên {name} với MSSV {student_id} thành công!")
                     else:
                         st.error("Không phát hiện khuôn mặt hoặc có nhiều khuôn mặt. Vui lòng chọn ảnh khác với chỉ một khuôn mặt.")
 
+        burst = st.session_state.get('burst_enrolment')
+        if registration_method == "Chụp nhiều khung hình (camera trực tiếp)" and burst is not None:
+            if not burst.is_done():
+                if live_frame is not None:
+                    img_array = np.array(Image.open(live_frame).convert('RGB'))
+                    burst.add_frame(recognizer, img_array)
+                st.progress(min(1.0, burst.elapsed() / burst.duration),
+                            text=f"Đang thu thập: {burst.frames} khung hình, {len(burst.candidates)} khung hình có khuôn mặt")
+            elif not burst.candidates:
+                st.error("Không thu được khung hình nào có đúng một khuôn mặt. Vui lòng chụp lại.")
+            else:
+                selected = select_diverse_templates(burst.candidates)
+                st.write(f"Đã chọn {len(selected)} ảnh mẫu từ {len(burst.candidates)}/{burst.frames} khung hình "
+                         f"(thu thập {burst.collection_seconds():.1f} s, phát hiện khuôn mặt {burst.detect_seconds:.1f} s).")
+                st.image([burst.candidates[i].chip for i in selected],
+                         caption=[f"Chất lượng {burst.candidates[i].quality:.2f}" for i in selected], width=112)
+                _, session_ids, _, session_embeddings = load_embeddings_by_session(session_id)
+                impostors = [embedding for id_, embedding in zip(session_ids, session_embeddings) if id_ != student_id]
+                report = compare_with_single_shot(burst.candidates, selected, impostors, match_config)
+                margin_rows = []
+                for label, margins in [("Một ảnh", report['single_shot']), ("Nhiều khung hình", report['burst'])]:
+                    if margins is not None:
+                        margin_rows.append([label, f"{margins['accepted']}/{margins['probes']}", round(margins['threshold_margin_mean'], 3),
+                                            round(margins['threshold_margin_min'], 3), round(margins.get('impostor_margin_min', float('nan')), 3)])
+                if margin_rows:
+                    st.write("Biên so khớp trên các khung hình không dùng làm ảnh mẫu:")
+                    st.dataframe(pd.DataFrame(margin_rows, columns=['Cách đăng ký', 'Được chấp nhận', 'Biên ngưỡng TB', 'Biên ngưỡng nhỏ nhất', 'Biên nhầm lẫn nhỏ nhất']))
+                if st.button("Lưu các ảnh mẫu đã chọn") and name and student_id:
+                    existing_name = get_student_name(student_id)
+                    if existing_name and existing_name.lower().strip() != name.lower().strip():
+                        st.error(f"MSSV {student_id} đã tồn tại với tên '{existing_name}'. Vui lòng nhập đúng tên.")
+                    else:
+                        start = time.perf_counter()
+                        record_ids = save_burst_templates(student_id, name, session_id, [burst.candidates[i] for i in selected], recognizer)
+                        del st.session_state['burst_enrolment']
+                        st.success(f"Đã đăng ký {len(record_ids)} ảnh mẫu cho sinh viên {name} với MSSV {student_id} "
+                                   f"(tổng thời gian {burst.elapsed():.1f} s, lưu {(time.perf_counter() - start) * 1000:.0f} ms).")
+
 elif page == "Tạo Buổi Thực Tập":
     st.header("Tạo Buổi Thực Tập Mới")
     today = datetime.now(tz).date()
@@ -677,6 +756,48 @@ elif page == "Tạo Buổi Thực Tập":
         if session_id:
             st.success(f"Đã tạo buổi thực tập mới với ID: {session_id}")
 
+    # Sửa giờ của buổi thực tập và tính lại điểm chuyên cần đã ghi nhận
+    st.header("Sửa Buổi Thực Tập")
+    sessions = get_sessions()
+    if sessions:
+        edit_options = [f"Buổi {s[0]} - {s[1]} - {s[2]} ({s[3]})" for s in sessions]
+        edit_index = st.selectbox("Chọn Buổi Thực Tập cần sửa", range(len(sessions)), format_func=lambda i: edit_options[i])
+        edit_session = sessions[edit_index]
+        edit_session_id = edit_session[0]
+        new_start_time = st.time_input("Giờ bắt đầu mới", value=datetime.strptime(edit_session[4], "%H:%M").time(), key=f"edit_start_{edit_session_id}")
+        new_end_time = st.time_input("Giờ kết thúc mới", value=datetime.strptime(edit_session[5], "%H:%M").time(), key=f"edit_end_{edit_session_id}")
+        new_max_score = st.number_input("Điểm chuyên cần tối đa mới (1-10)", min_value=1, max_value=10, value=edit_session[6], key=f"edit_max_{edit_session_id}")
+        new_session_info = {
+            'session_date': edit_session[2],
+            'start_time': new_start_time.strftime("%H:%M"),
+            'end_time': new_end_time.strftime("%H:%M"),
+            'max_attendance_score': new_max_score,
+        }
+        conn = sqlite3.connect('attendance.db')
+        changed_rows = preview_rescore(conn, edit_session_id, new_session_info)
+        conn.close()
+        preview_columns = ['MSSV', 'Giờ điểm danh', 'Điểm cũ', 'Ghi chú cũ', 'Điểm mới', 'Ghi chú mới']
+        edited_rows = [row[:6] for row in changed_rows if not row[6]]
+        correction_rows = [row[:6] for row in changed_rows if row[6]]
+        if edited_rows:
+            st.write(f"Có {len(edited_rows)} bản ghi điểm danh sẽ thay đổi do thông tin mới của buổi thực tập:")
+            st.dataframe(pd.DataFrame(edited_rows, columns=preview_columns))
+        else:
+            st.write("Không có bản ghi điểm danh nào thay đổi do thông tin mới của buổi thực tập.")
+        include_corrections = False
+        if correction_rows:
+            st.warning(f"Có {len(correction_rows)} bản ghi gần giờ bắt đầu/kết thúc được tính theo cách cũ (khung giờ bị lệch sớm 7 phút). "
+                       "Các bản ghi này không phụ thuộc vào phần được sửa và chỉ thay đổi nếu chọn sửa bên dưới.")
+            st.dataframe(pd.DataFrame(correction_rows, columns=preview_columns))
+            include_corrections = st.checkbox("Sửa cả các bản ghi được tính theo cách cũ", value=False, key=f"edit_corrections_{edit_session_id}")
+        if st.button("Lưu và tính lại điểm"):
+            conn = sqlite3.connect('attendance.db')
+            updated = update_session_and_rescore(conn, edit_session_id, new_session_info['start_time'], new_session_info['end_time'], new_max_score,
+                                                 include_corrections)
+            conn.close()
+            event_bus.publish('session_rescored', session_id=edit_session_id, updated=updated)
+            st.success(f"Đã cập nhật buổi thực tập {edit_session_id} và tính lại điểm cho {updated} bản ghi.")
+
 elif page == "Điểm Danh":
     st.header("Điểm Danh Buổi Thực Tập")
     
@@ -689,55 +810,38 @@ elif page == "Điểm Danh":
         session_info = get_session_info(session_id)
         st.subheader(f"Điểm danh cho buổi thực tập: {session_info['class_name']} - {session_info['session_date']} ({session_info['session_day']})")
         
-        record_ids, ids, names, embeddings = load_embeddings_by_session(session_id)
+        # Giữ ảnh chụp của phiên bản hiện tại cho phiên làm việc này, trả lại ảnh chụp của lần chạy trước
+        gallery_lease = get_gallery_registry().acquire(session_id)
+        previous_lease = st.session_state.get('gallery_lease')
+        st.session_state['gallery_lease'] = gallery_lease
+        if previous_lease is not None:
+            previous_lease.release()
         
         attendance_method = st.selectbox("Chọn phương thức điểm danh", ["Chụp ảnh", "Tải lên ảnh", "Real-time camera"])
         
+        gallery = gallery_lease.snapshot.as_gallery()
+        
         if attendance_method == "Chụp ảnh":
             image_file = st.camera_input("Chụp ảnh để điểm danh")
             if image_file is not None:
                 image = Image.open(image_file)
                 img_array = np.array(image)
-                faces = recognizer.app.get(img_array)
-                if len(faces) == 1:
-                    embedding = faces[0].embedding
-                    record_id, student_id, student_name = find_closest_match(embedding, record_ids, ids, names, embeddings)
-                    if record_id is not None:
-                        if not check_attendance(session_id, student_id):
-                            now = datetime.now(tz)
-                            timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-                            start_time = datetime.strptime(f"{session_info['session_date']} {session_info['start_time']}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                            end_time = datetime.strptime(f"{session_info['session_date']} {session_info['end_time']}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                            late_threshold = end_time + timedelta(minutes=15)
-                            
-                            if start_time <= now <= end_time:
-                                attendance_score = session_info['max_attendance_score']
-                                note = ""
-                            elif end_time < now < late_threshold:
-                                attendance_score = 0
-                                note = ""
-                            elif late_threshold <= now:
-                                attendance_score = 0
-                                note = "Trễ >15p"
-                            else:
-                                attendance_score = 0
-                                note = "Điểm danh sau giờ kết thúc"
-                            
-                            mark_attendance(session_id, student_id, timestamp, attendance_score, note)
-                            message = f"Đã điểm danh: {student_name} (MSSV: {student_id}) lúc {timestamp} - Điểm chuyên cần: {attendance_score}"
-                            if note:
-                                message += f" - {note}"
-                            st.success(message)
-                            
-                            # Hiển thị hình ảnh của sinh viên
-                            image_path = get_student_image(record_id)
-                            if image_path and os.path.exists(image_path):
-                                student_image = Image.open(image_path)
-                                st.image(student_image.resize((300, 300)), caption=f"Hình ảnh của {student_name} (MSSV: {student_id})")
-                        else:
-                            st.warning(f"Sinh viên {student_name} (MSSV: {student_id}) đã được điểm danh trong buổi thực tập này.")
-                    else:
-                        st.error("Không nhận diện được sinh viên trong ảnh.")
+                result = process_attendance_frame(recognizer, img_array, session_id, session_info, gallery, match_config)
+                if result.status == 'marked':
+                    message = f"Đã điểm danh: {result.student_name} (MSSV: {result.student_id}) lúc {result.timestamp} - Điểm chuyên cần: {result.attendance_score}"
+                    if result.note:
+                        message += f" - {result.note}"
+                    st.success(message)
+                    
+                    # Hiển thị hình ảnh của sinh viên
+                    image_path = get_student_image(result.record_id)
+                    if image_path and os.path.exists(image_path):
+                        student_image = Image.open(image_path)
+                        st.image(student_image.resize((300, 300)), caption=f"Hình ảnh của {result.student_name} (MSSV: {result.student_id})")
+                elif result.status == 'already_marked':
+                    st.warning(f"Sinh viên {result.student_name} (MSSV: {result.student_id}) đã được điểm danh trong buổi thực tập này.")
+                elif result.status == 'unknown':
+                    st.error("Không nhận diện được sinh viên trong ảnh.")
                 else:
                     st.error("Ảnh không chứa đúng một khuôn mặt. Vui lòng chụp lại.")
         
@@ -746,56 +850,28 @@ elif page == "Điểm Danh":
             if uploaded_file is not None:
                 image = Image.open(uploaded_file)
                 img_array = np.array(image)
-                faces = recognizer.app.get(img_array)
-                if len(faces) == 1:
-                    embedding = faces[0].embedding
-                    record_id, student_id, student_name = find_closest_match(embedding, record_ids, ids, names, embeddings)
-                    if record_id is not None:
-                        if not check_attendance(session_id, student_id):
-                            now = datetime.now(tz)
-                            timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-                            start_time = datetime.strptime(f"{session_info['session_date']} {session_info['start_time']}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                            end_time = datetime.strptime(f"{session_info['session_date']} {session_info['end_time']}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                            late_threshold = end_time + timedelta(minutes=15)
-                            
-                            if start_time <= now <= end_time:
-                                attendance_score = session_info['max_attendance_score']
-                                note = ""
-                            elif end_time < now < late_threshold:
-                                attendance_score = 0
-                                note = ""
-                            elif late_threshold <= now:
-                                attendance_score = 0
-                                note = "Trễ >15p"
-                            else:
-                                attendance_score = 0
-                                note = "Điểm danh sau giờ kết thúc"
-                            
-                            mark_attendance(session_id, student_id, timestamp, attendance_score, note)
-                            message = f"Đã điểm danh: {student_name} (MSSV: {student_id}) lúc {timestamp} - Điểm chuyên cần: {attendance_score}"
-                            if note:
-                                message += f" - {note}"
-                            st.success(message)
-                            
-                            # Hiển thị hình ảnh của sinh viên
-                            image_path = get_student_image(record_id)
-                            if image_path and os.path.exists(image_path):
-                                student_image = Image.open(image_path)
-                                st.image(student_image.resize((300, 300)), caption=f"Hình ảnh của {student_name} (MSSV: {student_id})")
-                        else:
-                            st.warning(f"Sinh viên {student_name} (MSSV: {student_id}) đã được điểm danh trong buổi thực tập này.")
-                    else:
-                        st.error("Không nhận diện được sinh viên trong ảnh.")
+                result = process_attendance_frame(recognizer, img_array, session_id, session_info, gallery, match_config)
+                if result.status == 'marked':
+                    message = f"Đã điểm danh: {result.student_name} (MSSV: {result.student_id}) lúc {result.timestamp} - Điểm chuyên cần: {result.attendance_score}"
+                    if result.note:
+                        message += f" - {result.note}"
+                    st.success(message)
+                    
+                    # Hiển thị hình ảnh của sinh viên
+                    image_path = get_student_image(result.record_id)
+                    if image_path and os.path.exists(image_path):
+                        student_image = Image.open(image_path)
+                        st.image(student_image.resize((300, 300)), caption=f"Hình ảnh của {result.student_name} (MSSV: {result.student_id})")
+                elif result.status == 'already_marked':
+                    st.warning(f"Sinh viên {result.student_name} (MSSV: {result.student_id}) đã được điểm danh trong buổi thực tập này.")
+                elif result.status == 'unknown':
+                    st.error("Không nhận diện được sinh viên trong ảnh.")
                 else:
                     st.error("Ảnh không chứa đúng một khuôn mặt. Vui lòng tải lên ảnh khác.")
         
         elif attendance_method == "Real-time camera":
             st.write("Chế độ điểm danh tự động...")
     
-            # Khởi tạo trạng thái trong st.session_state nếu chưa có
-            #if 'last_attended_student' not in st.session_state:
-            #    st.session_state['last_attended_student'] =None
-    
             image = camera_input_live()
             if image is not None:
                 image = Image.open(image)
@@ -804,66 +880,19 @@ elif page == "Điểm Danh":
                 # Chuyển đổi từ 4 kênh sang 3 kênh nếu cần
                     if len(img_array.shape) == 3 and img_array.shape[2] == 4:
                         img_array = img_array[:, :, :3]  # Loại bỏ kênh alpha
-                    faces = recognizer.app.get(img_array)
-                    if len(faces) == 1:
-                        embedding = faces[0].embedding
-                        record_id, student_id, student_name = find_closest_match(embedding, record_ids, ids, names, embeddings)
-                        if record_id is not None:
-
-                            image_path = get_student_image(record_id)
+                    result = process_attendance_frame(recognizer, img_array, session_id, session_info, gallery, match_config)
+                    if result.status == 'marked':
+                        message = f"Đã điểm danh: {result.student_name} (MSSV: {result.student_id}) lúc {result.timestamp} - Điểm chuyên cần: {result.attendance_score}"
+                        if result.note:
+                            message += f" - {result.note}"
+                        st.success(message)
+                    elif result.status == 'already_marked':
+                        st.warning(f"Sinh viên {result.student_name} (MSSV: {result.student_id}) đã được điểm danh trong buổi thực tập này.")
+                        image_path = get_student_image(result.record_id)
+                        if image_path and os.path.exists(image_path):
                             student_image = Image.open(image_path)
-
-                            if not check_attendance(session_id, student_id):
-                                now = datetime.now(tz)
-                                timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-                                start_time = datetime.strptime(f"{session_info['session_date']} {session_info['start_time']}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                                end_time = datetime.strptime(f"{session_info['session_date']} {session_info['end_time']}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                                late_threshold = end_time + timedelta(minutes=15)
-                
-                                if start_time <= now <= end_time:
-                                    attendance_score = session_info['max_attendance_score']
-                                    note = ""
-                                elif end_time < now < late_threshold:
-                                    attendance_score = 0
-                                    note = ""
-                                elif late_threshold <= now:
-                                    attendance_score = 0
-                                    note = "Trễ >15p"
-                                else:
-                                    attendance_score = 0
-                                    note = "Điểm danh sau giờ kết thúc"
-                
-                                mark_attendance(session_id, student_id, timestamp, attendance_score, note)
-                                message = f"Đã điểm danh: {student_name} (MSSV: {student_id}) lúc {timestamp} - Điểm chuyên cần: {attendance_score}"
-                                if note:
-                                    message += f" - {note}"
-                                st.success(message)
-                
-                                # Cập nhật thông tin và hình ảnh của sinh viên vào st.session_state
-                                #image_path = get_student_image(record_id)
-                                #if image_path and os.path.exists(image_path):
-                                #    student_image = Image.open(image_path)
-                                    #st.session_state['last_attended_student'] = {
-                                    #'name': student_name,
-                                    #'id': student_id,
-                                    #'image': student_image
-                                    #}
-
-                                #    st.subheader(
-                                #        f"Sinh viên đã được điểm danh: {student_name} (MSSV: {student_id})")
-
-                                    #st.rerun()
-                            else:
-                                #pass
-                                st.warning(f"Sinh viên {student_name} (MSSV: {student_id}) đã được điểm danh trong buổi thực tập này.")
-                                st.image(student_image.resize((300, 300)),
-                                         caption=f"Hình ảnh của {student_name} (MSSV: {student_id})")
-                        else:
-                            pass
-                            #st.error("Không nhận diện được sinh viên trong ảnh.")
-                    else:
-                        pass
-                        #st.error("Ảnh không chứa đúng một khuôn mặt. Vui lòng thử lại.")
+                            st.image(student_image.resize((300, 300)),
+                                     caption=f"Hình ảnh của {result.student_name} (MSSV: {result.student_id})")
     
             # Hiển thị thông tin và hình ảnh của sinh viên đã điểm danh gần nhất
             #if st.session_state['last_attended_student'] is not None:
@@ -871,21 +900,82 @@ elif page == "Điểm Danh":
             #    st.subheader(f"Sinh viên đã điểm danh gần nhất: {student['name']} (MSSV: {student['id']})")
             #    st.image(student['image'].resize((300, 300)), caption=f"Hình ảnh của {student['name']} (MSSV: {student['id']})")
 
+elif page == "Theo Dõi Điểm Danh":
+    st.header("Theo Dõi Điểm Danh Trực Tiếp")
+    sessions = get_sessions()
+    session_options = [f"Buổi {s[0]} - {s[1]} - {s[2]} ({s[3]})" for s in sessions]
+    selected_session = st.selectbox("Chọn Buổi Thực Tập", session_options, key='live_session')
+    
+    if selected_session:
+        session_id = int(selected_session.split()[1])
+        session_info = get_session_info(session_id)
+        st.subheader(f"{session_info['class_name']} - {session_info['session_date']} ({session_info['session_day']}), "
+                     f"{session_info['start_time']} - {session_info['end_time']}")
+        
+        # Đăng ký theo dõi trước rồi mới đọc danh sách một lần, các lần cập nhật sau chỉ dùng sự kiện từ bus.
+        # Danh sách từ cơ sở dữ liệu đã bao gồm các sự kiện cũ nên không cần phát lại.
+        def load_live_state():
+            subscription = event_bus.subscribe(session_id=session_id, replay=False)
+            arrivals = {row[0]: {'MSSV': row[0], 'Họ tên SV': row[1], 'Giờ điểm danh': row[2], 'Điểm': row[3], 'Ghi chú': row[4]}
+                        for row in get_attendance_list(session_id)}
+            return {'session_id': session_id, 'subscription': subscription, 'arrivals': arrivals, 'session_info': get_session_info(session_id)}
+        
+        live_state = st.session_state.get('live_dashboard')
+        if live_state is None or live_state['session_id'] != session_id:
+            if live_state is not None:
+                live_state['subscription'].close()
+            st.session_state['live_dashboard'] = load_live_state()
+        
+        @st.fragment(run_every=2)
+        def live_dashboard():
+            state = st.session_state['live_dashboard']
+            events = state['subscription'].poll()
+            # Bị bỏ sự kiện (hàng đợi đầy) hoặc điểm đã được tính lại: đồng bộ lại từ cơ sở dữ liệu
+            if state['subscription'].dropped or any(event['type'] == 'session_rescored' for event in events):
+                state['subscription'].close()
+                state = st.session_state['live_dashboard'] = load_live_state()
+                events = state['subscription'].poll()
+            for event in events:
+                if event['type'] == 'attendance_marked':
+                    state['arrivals'].setdefault(event['student_id'], {
+                        'MSSV': event['student_id'], 'Họ tên SV': event['student_name'], 'Giờ điểm danh': event['timestamp'],
+                        'Điểm': event['attendance_score'], 'Ghi chú': event['note']})
+                elif event['type'] == 'attendance_deleted':
+                    state['arrivals'].pop(event['student_id'], None)
+            arrivals = sorted(state['arrivals'].values(), key=lambda arrival: arrival['Giờ điểm danh'], reverse=True)
+            late_count = sum(1 for arrival in arrivals if is_late(state['session_info'], arrival['Giờ điểm danh']))
+            col1, col2 = st.columns(2)
+            col1.metric("Đã điểm danh", len(arrivals))
+            col2.metric("Điểm danh trễ", late_count)
+            if arrivals:
+                st.write("Sinh viên điểm danh gần nhất:")
+                st.dataframe(pd.DataFrame(arrivals[:20]), hide_index=True)
+            else:
+                st.write("Chưa có sinh viên nào điểm danh.")
+        
+        live_dashboard()
+
 elif page == "Xem Sinh Viên":
     view_students_page()
 
 elif page == "Xem Điểm Danh":
     st.header("Xem Danh Sách Điểm Danh")
     sessions = get_sessions()
+    archived_sessions = get_archived_sessions()
     session_options = [f"Buổi {s[0]} - {s[1]} - {s[2]} ({s[3]})" for s in sessions]
-    selected_session = st.selectbox("Chọn Buổi Thực Tập", session_options)
+    # Các buổi đã lưu trữ được đọc trực tiếp từ file lưu trữ (chỉ xem)
+    session_options += [f"Lưu trữ {s['id']} - {s['class_name']} - {s['session_date']} ({s['session_day']})" for s in archived_sessions]
+    session_keys = [(False, s[0]) for s in sessions] + [(True, s['id']) for s in archived_sessions]
+    selected_index = st.selectbox("Chọn Buổi Thực Tập", range(len(session_options)), format_func=lambda i: session_options[i])
     
-    if selected_session:
-        session_id = int(selected_session.split()[1])
-        session_info = get_session_info(session_id)
+    if selected_index is not None:
+        is_archived, session_id = session_keys[selected_index]
+        session_info = get_archived_session_info(session_id) if is_archived else get_session_info(session_id)
         st.subheader(f"Danh sách sinh viên đã điểm danh cho buổi thực tập: {session_info['class_name']} - {session_info['session_date']} ({session_info['session_day']})")
+        if is_archived:
+            st.info("Buổi thực tập này đã được lưu trữ. Dữ liệu chỉ có thể xem và tải về.")
         
-        attendance_list = get_attendance_list(session_id)
+        attendance_list = load_archived_attendance(session_id) if is_archived else get_attendance_list(session_id)
         
         if attendance_list:
             df = pd.DataFrame(attendance_list, columns=['MSSV', 'Họ tên SV', 'Giờ điểm danh', 'Điểm', 'Ghi chú', 'Khối thực tập', 'Ngày', 'Thứ', 'Giờ bắt đầu', 'Giờ kết thúc'])
@@ -903,14 +993,16 @@ elif page == "Xem Điểm Danh":
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
             
-            st.subheader("Xóa Record Điểm Danh")
-            selected_student_id = st.selectbox("Chọn MSSV để xóa", df['MSSV'])
-            if st.button("Xóa Record Này"):
-                conn = get_db_connection()
-                conn.execute("DELETE FROM attendance WHERE session_id = ? AND student_id = ?", (session_id, selected_student_id))
-                conn.commit()
-                conn.close()
-                st.success(f"Đã xóa record điểm danh của sinh viên {selected_student_id}.")
-                st.rerun()
+            if not is_archived:
+                st.subheader("Xóa Record Điểm Danh")
+                selected_student_id = st.selectbox("Chọn MSSV để xóa", df['MSSV'])
+                if st.button("Xóa Record Này"):
+                    conn = get_db_connection()
+                    conn.execute("DELETE FROM attendance WHERE session_id = ? AND student_id = ?", (session_id, selected_student_id))
+                    conn.commit()
+                    conn.close()
+                    event_bus.publish('attendance_deleted', session_id=session_id, student_id=selected_student_id)
+                    st.success(f"Đã xóa record điểm danh của sinh viên {selected_student_id}.")
+                    st.rerun()
         else:
             st.write("Không có sinh viên nào được ghi nhận.")